@@ -1,18 +1,22 @@
-from typing import Any, Union, List
-import json
+from typing import Any, AsyncIterator, Union, List, Optional
+import functools
+import hashlib
 from langchain_core.messages import (
+  AIMessage,
   BaseMessage,
   HumanMessage,
   SystemMessage
 )
 
-from langchain_openai import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
 from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.prompts.chat import MessagesPlaceholder
-from langchain.chains.openai_functions import create_structured_output_runnable
-from langchain_core.messages import AIMessage
-from langchain_core.prompts.chat import SystemMessagePromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
+
+from utils.config import load_config, load_prompt, resolve_path
+from utils.llm import make_llm
+from utils.messages import trim_to_token_budget
 
 
 class FinalResponse(BaseModel):
@@ -27,6 +31,23 @@ class Replan(BaseModel):
   )
 
 
+# Replan that can also carry a draft answer, used when early finish is turned on. The
+# class docstrings and titles end up in the function schema the LLM sees, so the draft
+# models keep the titles (and docstrings) of the models they extend.
+class ReplanWithDraft(Replan):
+  class Config:
+    title = "Replan"
+
+  draft_response: Optional[str] = Field(
+    default=None,
+    description="The best answer that can be given with the information gathered so far, if any."
+  )
+  confidence: Optional[float] = Field(
+    default=None,
+    description="How confident you are, from 0 to 1, that the draft response already answers the question."
+  )
+
+
 class JoinOutputs(BaseModel):
   """Decide whether to replan or whether you can return the final response."""
 
@@ -35,33 +56,171 @@ class JoinOutputs(BaseModel):
   )
   action: Union[FinalResponse, Replan]
 
+
+class JoinOutputsWithDraft(JoinOutputs):
+  class Config:
+    title = "JoinOutputs"
+
+  action: Union[FinalResponse, ReplanWithDraft]
+
+
 # Read config file
-with open('compiler_agent/config.json', 'r') as f:
-  config = json.load(f)
+config = load_config()
 
 # Read joiner prompt from local file
-with open('compiler_agent/prompts/joiner_1.txt', 'r') as file:
-  joiner_prompt_1 = file.read()
-with open('compiler_agent/prompts/joiner_2.txt', 'r') as file:
-  joiner_prompt_2 = file.read()
-
-# Since this one has input variables, it is set separately
-joiner_prompt_template_2 = SystemMessagePromptTemplate.from_template(template=joiner_prompt_2)
-
-joiner_prompt = ChatPromptTemplate.from_messages(
-  [
-    SystemMessage(content=joiner_prompt_1),
-    MessagesPlaceholder(variable_name='messages'),
-    joiner_prompt_template_2
-  ]
-)
+joiner_prompt_1 = load_prompt('joiner_1.txt')
+joiner_prompt_2 = load_prompt('joiner_2.txt')
+# Guidance for the draft answer, only sent when early finish is turned on
+joiner_prompt_draft = load_prompt('joiner_draft.txt')
 
 # Optional: set any examples here
-joiner_prompt = joiner_prompt.partial(examples='')
+joiner_examples = ''
+
+def _early_finish_enabled() -> bool:
+  '''Early finish is on when 'joiner_early_finish_confidence' is set in the config. Only
+  then is the joiner asked for a draft answer, otherwise the extra schema fields and
+  prompt lines would cost tokens on every call for nothing.
+  '''
+  return config.get('joiner_early_finish_confidence') is not None
+
+
+def _joiner_outputs_model() -> type:
+  '''The function schema the joiner is forced to call, with the draft answer fields
+  only when early finish is on.'''
+  return JoinOutputsWithDraft if _early_finish_enabled() else JoinOutputs
+
+
+def _build_joiner_prompt() -> ChatPromptTemplate:
+  '''Both joiner prompts are static, so they are joined into one system message that
+  comes before the messages. Providers cache prompt prefixes (OpenAI does this
+  automatically once the prefix is long enough), and only the part before the first
+  changing message can be cached. With the messages placed last, the whole system
+  prompt is a stable prefix across joiner calls. The examples are filled in once here
+  with a plain str.format, so there is no template to build or partial to apply.
+  '''
+  prompt_1 = joiner_prompt_1
+  if _early_finish_enabled():
+    prompt_1 = f"{prompt_1}\n{joiner_prompt_draft}"
+  joiner_system_prompt = f"{prompt_1}\n\n{joiner_prompt_2.format(examples=joiner_examples)}"
+
+  return ChatPromptTemplate.from_messages(
+    [
+      SystemMessage(content=joiner_system_prompt),
+      MessagesPlaceholder(variable_name='messages')
+    ]
+  )
+
+
+def _init_gptcache(cache_obj: Any, llm: str):
+  '''Sets up a GPTCache similarity cache. Each model gets its own data directory, named
+  from a hash of the model settings, so different models never share answers.
+  '''
+  from gptcache.adapter.api import init_similar_cache
+
+  hashed_llm = hashlib.sha256(llm.encode()).hexdigest()
+  init_similar_cache(
+    cache_obj=cache_obj, data_dir=resolve_path(f"similar_cache_{hashed_llm}")
+  )
+
+
+def _build_joiner_cache(cache_config: dict):
+  '''Builds the response cache for the joiner from the 'joiner_cache' config section.
+  - 'sqlite': Exact match cache. Only identical prompts are answered from the cache.
+  - 'semantic': GPTCache similarity cache. Prompts that are close in meaning (a
+    rephrased question, tool results that differ by whitespace) reuse a previous
+    decision. Needs the optional 'gptcache' package.
+  '''
+  if cache_config['type'] == 'semantic':
+    # Imported here because gptcache is optional, only needed for the semantic cache.
+    from langchain_community.cache import GPTCache
+    return GPTCache(_init_gptcache)
+
+  from langchain_community.cache import SQLiteCache
+  return SQLiteCache(database_path=resolve_path(cache_config['database_path']))
+
+
+@functools.cache
+def _get_llm() -> BaseChatModel:
+  '''Builds the joiner's LLM on first use. Creating the OpenAI client and the cache is
+  deferred until the joiner is actually called, so importing this module stays cheap.
+  '''
+  # The joiner gets its own response cache. Replans send the joiner the same recent
+  # messages again and again, so repeated calls are answered from the local cache
+  # instead of making another round trip to the API.
+  return make_llm(
+    **config['joiner_llm'],
+    cache=_build_joiner_cache(config['joiner_cache'])
+  )
+
+
+@functools.cache
+def _get_runnable() -> Runnable:
+  '''Builds the joiner's structured output runnable on first use. The LLM is forced to
+  call the JoinOutputs function and the JSON parser returns the function arguments as a
+  dict, see _decision_from_arguments for turning them into a JoinOutputs. When streamed,
+  the parser emits the arguments parsed so far each time a new chunk comes in. The
+  prompt and the function schema only ask for a draft answer when early finish is on.
 
-llm = ChatOpenAI(**config['joiner_llm'])
+  This is what create_structured_output_runnable does, minus the pydantic validation of
+  the output. The models stay on langchain_core.pydantic_v1 because LangChain builds the
+  function schema from them with pydantic v1.
+  '''
+  return (
+    _build_joiner_prompt()
+    | _get_llm().bind_functions([_joiner_outputs_model()], function_call="JoinOutputs")
+    | JsonOutputFunctionsParser()
+  )
+
+
+def _decision_from_arguments(arguments: dict) -> JoinOutputs:
+  '''Builds the JoinOutputs from the LLM's function call arguments without running
+  pydantic validation. The arguments follow the function schema, so when the expected
+  string fields are there the models are made with construct(). Anything else goes
+  through parse_obj() so a malformed call still raises the usual validation error.
+
+  'response' is checked first to match how pydantic picks the Union member, FinalResponse
+  is tried before Replan.
+  '''
+  thought = arguments.get("thought")
+  action = arguments.get("action")
+  if isinstance(thought, str) and isinstance(action, dict):
+    if isinstance(action.get("response"), str):
+      return JoinOutputs.construct(
+        thought=thought, action=FinalResponse.construct(response=action["response"])
+      )
+    if isinstance(action.get("feedback"), str):
+      if not _early_finish_enabled():
+        replan = Replan.construct(feedback=action["feedback"])
+      else:
+        replan = ReplanWithDraft.construct(
+          feedback=action["feedback"],
+          draft_response=action.get("draft_response"),
+          confidence=action.get("confidence")
+        )
+      return JoinOutputs.construct(thought=thought, action=replan)
+  return _joiner_outputs_model().parse_obj(arguments)
+
+
+def _is_confident_draft(action: Replan) -> bool:
+  '''Checks if a replan has a draft response with a confidence at or above the
+  configured threshold. A threshold of null in the config turns this off.
+  '''
+  threshold = config.get('joiner_early_finish_confidence')
+  return (
+    threshold is not None
+    and isinstance(action, ReplanWithDraft)
+    and isinstance(action.draft_response, str)
+    and action.draft_response.strip() != ""
+    and isinstance(action.confidence, (int, float))
+    and action.confidence >= threshold
+  )
+
+
+def _thought_message(thought: str) -> AIMessage:
+  '''The joiner's thought as a message. Used by both the regular and the streaming
+  joiner so they produce the exact same messages.'''
+  return AIMessage.construct(content=f"Thought: {thought}")
 
-runnable = create_structured_output_runnable(JoinOutputs, llm, joiner_prompt)
 
 def _parse_joiner_output(decision: JoinOutputs) -> List[BaseMessage]:
   '''This function parses the LLM the output from the joiner prompt. That prompt asks
@@ -77,18 +236,37 @@ def _parse_joiner_output(decision: JoinOutputs) -> List[BaseMessage]:
   return list.
 
   Returns either a list that is:
-  - [AIMessage]: Indicates the action was 'Finish'.
+  - [AIMessage, AIMessage]: Indicates the action was 'Finish'. The second message is the
+    final response.
   - [AIMessage, SystemMessage]: Indicates the action was 'Replan'
+
+  A replan that comes with a draft response the LLM is confident in (see
+  'joiner_early_finish_confidence' in the config) is treated as 'Finish' with the draft
+  as the final response. That saves a whole planner round trip when the LLM only wants
+  to double check an answer it already has.
   '''
-  response = [AIMessage(content=f"Thought: {decision.thought}")]
-  if isinstance(decision.action, Replan):
-    return response + [
-      SystemMessage(
-        content=f"Context from last attempt: {decision.action.feedback}"
+  action = decision.action
+  if isinstance(action, Replan) and _is_confident_draft(action):
+    action = FinalResponse.construct(response=action.draft_response)
+  # The decision's contents are plain strings straight from the function call, so the
+  # messages are made with construct() which skips running pydantic validation.
+  response = [_thought_message(decision.thought)]
+  # The action is a FinalResponse or a Replan (ReplanWithDraft when early finish is on,
+  # which is still a Replan).
+  # The last message is stamped with where the graph goes next, so the planner and the
+  # graph's edge can read the decision off the message instead of checking its type.
+  if isinstance(action, Replan):
+    response.append(
+      SystemMessage.construct(
+        content=f"Context from last attempt: {action.feedback}",
+        additional_kwargs={"route": "replan"}
       )
-    ]
+    )
   else:
-    return response + [AIMessage(content=decision.action.response)]
+    response.append(
+      AIMessage.construct(content=action.response, additional_kwargs={"route": "final"})
+    )
+  return response
 
 
 def select_recent_messages(messages: list) -> dict:
@@ -97,19 +275,98 @@ def select_recent_messages(messages: list) -> dict:
   human message, then we cutoff. So if there's a back and forth with the human this will
   only keep system/ai messages since then.
   '''
-  selected = []
-  # Reverse the list
-  for msg in messages[::-1]:
-    selected.append(msg)
-    if isinstance(msg, HumanMessage):
-      break
-  # Return reversed list
-  return {"messages": selected[::-1]}
+  # Walk the indexes backwards to find the most recent human message, then slice from
+  # there. This avoids copying and reversing the list twice.
+  for i in range(len(messages) - 1, -1, -1):
+    if isinstance(messages[i], HumanMessage):
+      return {"messages": messages[i:]}
+  # No human message, keep everything
+  return {"messages": list(messages)}
+
+
+def _trim_recent_messages(recent_messages: dict) -> dict:
+  '''Drops the middle of the recent messages when they don't fit in the joiner's token
+  budget ('joiner_max_tokens' in the config). The question and the newest results are
+  kept.
+  '''
+  return {
+    "messages": trim_to_token_budget(
+      recent_messages["messages"],
+      max_tokens=config['joiner_max_tokens'],
+      model=config['joiner_llm']['model']
+    )
+  }
+
+
+def _joiner(messages: List[BaseMessage], config: RunnableConfig) -> List[BaseMessage]:
+  '''Selects the recent messages, asks the LLM for a decision and turns it into
+  messages. These steps always run together, so they are done in one function rather
+  than piped as three runnables, which would each add their own invoke and callback
+  overhead on every joiner call.
+  '''
+  recent_messages = select_recent_messages(messages)
+  arguments = _get_runnable().invoke(_trim_recent_messages(recent_messages), config)
+  return _parse_joiner_output(_decision_from_arguments(arguments))
+
+
+async def _ajoiner(
+  messages: List[BaseMessage], config: RunnableConfig
+) -> List[BaseMessage]:
+  '''Async version of _joiner. Used when the graph is run with ainvoke/astream, so the
+  LLM call is awaited on the event loop instead of tying up a thread while it waits.
+  '''
+  recent_messages = select_recent_messages(messages)
+  arguments = await _get_runnable().ainvoke(
+    _trim_recent_messages(recent_messages), config
+  )
+  return _parse_joiner_output(_decision_from_arguments(arguments))
+
+
+joiner = RunnableLambda(_joiner, afunc=_ajoiner)
+
+async def astream_joiner(
+  messages: List[BaseMessage], config: Optional[RunnableConfig] = None
+) -> AsyncIterator[BaseMessage]:
+  '''Async streaming version of the joiner. It yields the same messages the joiner
+  returns, but doesn't wait for the whole response before starting.
+
+  The LLM writes the 'thought' argument before the 'action' argument. Once the action
+  has started streaming in and the thought is unchanged from the chunk before, the
+  thought is complete and its AIMessage is yielded while the rest is still being
+  generated. When a final response is given, this is often most of the output. Once the
+  stream ends, the full decision is built and the remaining message(s) are yielded. In
+  the rare case the thought still changed after it was sent, the full thought is
+  yielded again so it isn't lost. Every message comes from the same helpers as the
+  regular joiner, so the last one carries the same 'route' stamp that should_continue
+  reads.
+  '''
+  arguments = {}
+  sent_thought = None
+  previous_thought = None
+  async for arguments in _get_runnable().astream(
+    _trim_recent_messages(select_recent_messages(messages)), config
+  ):
+    if sent_thought is not None or "action" not in arguments:
+      continue
+    # Partial strings come back closed, so a thought that's still streaming (if the
+    # keys came in another order) looks complete. Only trust it once it stops growing.
+    thought = arguments.get("thought")
+    if thought is not None and thought == previous_thought:
+      sent_thought = thought
+      yield _thought_message(thought)
+    previous_thought = thought
 
+  decision = _decision_from_arguments(arguments)
+  response = _parse_joiner_output(decision)
+  # Skip the thought message if the same thought was already sent
+  skip_thought = sent_thought is not None and sent_thought == decision.thought
+  for message in response[1:] if skip_thought else response:
+    yield message
 
-joiner = select_recent_messages | runnable | _parse_joiner_output
 
 # Example usage
 # example_question = "What's the temperature in SF raised to the 3rd power?"
 # input_messages = [HumanMessage(content=example_question)] + tool_messages
-# joiner.invoke(input_messages)
\ No newline at end of file
+# joiner.invoke(input_messages)
+# Or from async code:
+# await joiner.ainvoke(input_messages)
\ No newline at end of file
@@ -1,11 +1,17 @@
+import asyncio
+import functools
+import os
 from langgraph.graph import MessageGraph, END
 from typing import Dict, List
-from langchain_core.messages import BaseMessage, AIMessage, HumanMessage
+from langchain_core.messages import BaseMessage, HumanMessage
 from task_fetching_unit import plan_and_schedule
 from joiner import joiner
 from langchain.globals import set_verbose, set_debug
 
-set_verbose(True)
+# Verbose output formats and prints every runnable's inputs and outputs, which gets
+# expensive as the message list grows over many replans. Only turn it on when asked.
+verbose = os.getenv("LLM_COMPILER_VERBOSE") == "1"
+set_verbose(verbose)
 # set_debug(True)
 
 workflow = MessageGraph()
@@ -46,7 +52,9 @@ def should_continue(state: List[BaseMessage]):
   - SystemMessage(content="Context from last attempt: To answer the user's question, we need the specific GDP value for New York, NY (MSA). A direct extraction of this value from the provided URL or a summary of its content would be necessary. The current result only indicates the availability of such data without specifying it.")
   - AIMessage(content="I'm unable to find the exact GDP value for New York from the provided sources. The information mentions the real GDP of New York from 2017 to 2022 but does not specify the numbers. For the most accurate and up-to-date figures, I recommend checking official economic reports or databases such as the U.S. Bureau of Economic Analysis or Statista directly.")
   '''
-  if isinstance(state[-1], AIMessage):
+  # The joiner stamps its last message with the route it decided on, 'final' when it has
+  # the answer, so the edge just reads it back.
+  if state[-1].additional_kwargs.get("route") == "final":
     return END
   return "plan_and_schedule"
 
@@ -69,104 +77,113 @@ workflow.add_conditional_edges(
 
 workflow.set_entry_point("plan_and_schedule")
 
-chain = workflow.compile()
+@functools.cache
+def get_chain():
+  '''Compiles the graph once and hands back the same compiled graph on every call.
+  Runs are stateless, each one gets its whole conversation as input, so no checkpointer
+  is set and nothing is saved between runs. Compiled graphs are safe to share between
+  concurrent runs, every run keeps its state to itself.
+  '''
+  return workflow.compile(checkpointer=None)
 
 
+chain = get_chain()
 
 
-# Example Usage
+async def arun(
+  messages: List[BaseMessage], recursion_limit: int = 60
+) -> List[BaseMessage]:
+  '''Runs the graph on the given messages with ainvoke and returns the final message
+  state. The LLM calls are awaited rather than blocking a thread, so many runs can share
+  one event loop.
+  '''
+  return await chain.ainvoke(messages, {"recursion_limit": recursion_limit})
 
-# *** Example 1 - Simple Question
-for step in chain.stream(
-  [HumanMessage(content="What's the GDP of New York?")],
-  {"recursion_limit": 40}
-):
-  print(step)
-  print("---")
-# Final answer
-print(step[END][-1].content)
-
-
-# *** Example 2 - Multi-Hop Question
-steps = chain.stream(
-  [HumanMessage(content="What's the oldest parrot alive, and how much longer is that than the average?")],
-  {"recursion_limit": 60}
-)
-for step in steps:
-  print(step)
-  print("---")
-# Final answer
-print(step[END][-1].content)
-'''
-This example #2 question highlights an issue with the math function that needs to be
-fixed somehow. Here's the output it wants to generate:
-
-1. tavily_search_results_json(query="oldest parrot alive")
-2. tavily_search_results_json(query="average lifespan of a parrot")
-3. math(problem="${1} - ${2}", context=["oldest parrot alive", "average lifespan of a parrot"])
-4. join()<END_OF_PLAN>
-
-Step 3 is the problem. It should be like this:
-3. math(problem="oldest parrot alive minus average lifespan of a parrot", context=[${1},${2}])
-
-Couple issues or fixes:
-- The context parameters will fill in with search results, but they don't say what query
-  generated those results, and this might be crucial information.
-- We could have the llm just fill the 'problem' param with everything, the query and
-  the context.
-- We probably need a processing step before the math step, it likely would be part of
-  math function, it would just have a two step process. Which it already has, so maybe
-  just tweak it to handle this case.
-'''
-
-
-### The next two examples will be the inverse of eachother to test and make sure it can
-### correctly do reasoning to answer the question. In one case the answer will follow
-### the question so the answer is straightforward, in the other question the answer will
-### be inverted from the question which will make sure the LLM can correctly see this
-### and give the right answer still. So between these two answers, one should give an
-### amount, but the other should not give an amount, but state that it's already higher.
-
-# *** Example 3 - Multi-Hop Question
-steps = chain.stream(
-  [HumanMessage(content="How much does Microsoft's market cap need to increase to exceed Apple's market cap?")],
-  {"recursion_limit": 60}
-)
-for step in steps:
-  print(step)
-  print("---")
-# Final answer
-print(step[END][-1].content)
 
+async def run_batch(
+  questions: List[str], max_concurrency: int = 10, recursion_limit: int = 60
+) -> List[List[BaseMessage]]:
+  '''Runs several independent questions through the graph at the same time and returns
+  the final message state for each one, in the same order as the questions.
 
-# *** Example 4 - Multi-Hop Question
-steps = chain.stream(
-  [HumanMessage(content="How much does Apple's market cap need to increase to exceed Microsoft's market cap?")],
-  {"recursion_limit": 60}
-)
-for step in steps:
-  print(step)
-  print("---")
-# Final answer
-print(step[END][-1].content)
-
-
-# *** Example 5 - Multi-Step Math Question
-for step in chain.stream(
-  [HumanMessage(content="What's ((3*(4+5)/0.5)+3245) + 8? What's 32/4.23? What's the sum of those two values?")]
-):
-  print(step)
-  print("---")
-# Final answer
-print(step[END][-1].content)
-
-
-# *** Example 6 - Conversational test, it should respond simply with a greeting.
-for step in chain.stream(
-  [HumanMessage(content="Hello robot! 🤖")]
-):
-  print(step)
-  print("---")
-
-# Final answer
-print(step[END][-1].content)
\ No newline at end of file
+  Every question only waits on its own LLM and tool calls, so running them together
+  overlaps the network waits of the planner, joiner and tools across questions. At most
+  'max_concurrency' questions run at once, which keeps large batches under the API rate
+  limits.
+  '''
+  return await chain.abatch(
+    [[HumanMessage(content=question)] for question in questions],
+    {"max_concurrency": max_concurrency, "recursion_limit": recursion_limit},
+  )
+
+
+# Streaming example, prints each step of the graph as it finishes:
+# async def print_steps(question: str):
+#   async for step in chain.astream(
+#     [HumanMessage(content=question)], {"recursion_limit": 60}
+#   ):
+#     print(step)
+#     print("---")
+# asyncio.run(print_steps("What's the GDP of New York?"))
+
+
+# Example Usage
+
+EXAMPLE_QUESTIONS = [
+  # *** Example 1 - Simple Question
+  "What's the GDP of New York?",
+
+  # *** Example 2 - Multi-Hop Question
+  # This question highlights an issue with the math function that needs to be fixed
+  # somehow. Here's the output it wants to generate:
+  #
+  # 1. tavily_search_results_json(query="oldest parrot alive")
+  # 2. tavily_search_results_json(query="average lifespan of a parrot")
+  # 3. math(problem="${1} - ${2}", context=["oldest parrot alive", "average lifespan of a parrot"])
+  # 4. join()<END_OF_PLAN>
+  #
+  # Step 3 is the problem. It should be like this:
+  # 3. math(problem="oldest parrot alive minus average lifespan of a parrot", context=[${1},${2}])
+  #
+  # Couple issues or fixes:
+  # - The context parameters will fill in with search results, but they don't say what
+  #   query generated those results, and this might be crucial information.
+  # - We could have the llm just fill the 'problem' param with everything, the query and
+  #   the context.
+  # - We probably need a processing step before the math step, it likely would be part
+  #   of math function, it would just have a two step process. Which it already has, so
+  #   maybe just tweak it to handle this case.
+  "What's the oldest parrot alive, and how much longer is that than the average?",
+
+  ### The next two examples will be the inverse of eachother to test and make sure it can
+  ### correctly do reasoning to answer the question. In one case the answer will follow
+  ### the question so the answer is straightforward, in the other question the answer
+  ### will be inverted from the question which will make sure the LLM can correctly see
+  ### this and give the right answer still. So between these two answers, one should
+  ### give an amount, but the other should not give an amount, but state that it's
+  ### already higher.
+
+  # *** Example 3 - Multi-Hop Question
+  "How much does Microsoft's market cap need to increase to exceed Apple's market cap?",
+
+  # *** Example 4 - Multi-Hop Question
+  "How much does Apple's market cap need to increase to exceed Microsoft's market cap?",
+
+  # *** Example 5 - Multi-Step Math Question
+  "What's ((3*(4+5)/0.5)+3245) + 8? What's 32/4.23? What's the sum of those two values?",
+
+  # *** Example 6 - Conversational test, it should respond simply with a greeting.
+  "Hello robot! 🤖",
+]
+
+
+if __name__ == "__main__":
+  # The examples don't share any state, so they all run at the same time. The total time
+  # is about as long as the slowest example instead of the sum of all of them.
+  final_states = asyncio.run(run_batch(EXAMPLE_QUESTIONS))
+
+  for question, state in zip(EXAMPLE_QUESTIONS, final_states):
+    print(question)
+    # Final answer
+    print(state[-1].content)
+    print("---")
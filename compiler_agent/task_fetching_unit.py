@@ -2,38 +2,139 @@ from typing import (
   Any,
   Union,
   Iterable,
+  Iterator,
   List,
-  Dict
+  Dict,
+  Optional,
+  Set
 )
+import asyncio
+import atexit
+import functools
+import json
+import os
 import re
+from collections import defaultdict
+import threading
 import traceback
-import itertools
+import unicodedata
 from typing_extensions import TypedDict
-import time
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import ThreadPoolExecutor
 
-from langchain_core.messages import BaseMessage, FunctionMessage
-from langchain_core.runnables import chain as as_runnable
+from langchain_core.messages import BaseMessage, FunctionMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda, chain as as_runnable
 
+from utils.config import load_config
 from utils.output_parser import Task
-from utils.planner import planner
+from utils.planner import get_planner, planner_fingerprint
+from utils.tools import get_tools
+from utils.tool_cache import (
+  MISS,
+  build_tool_cache,
+  is_cacheable,
+  is_error_result,
+  make_key
+)
 
 # $1 or ${1} -> 1
 ID_PATTERN = r"\$\{?(\d+)\}?"
+_ID_RE = re.compile(ID_PATTERN)
+
+# One pool of worker threads shared by every schedule_tasks call, instead of spinning up
+# and joining a new pool for each plan. Tasks only reach the pool once their dependencies
+# are done, so sharing it between concurrent plans can't deadlock.
+_EXECUTOR = ThreadPoolExecutor(
+  max_workers=int(os.getenv("LLM_COMPILER_MAX_WORKERS", "16")),
+  thread_name_prefix="llm-compiler-task"
+)
+atexit.register(_EXECUTOR.shutdown, wait=False)
+
+@functools.cache
+def _tool_cache():
+  '''Results of tools marked cacheable, shared by every plan in the process. Stored,
+  sized and timed by 'tool_cache' in the config. Built on first use, so importing this
+  module doesn't open (or create) the database.
+  '''
+  return build_tool_cache(load_config()['tool_cache'])
+
+
+@functools.cache
+def _plan_cache():
+  '''Plans made for a new question, see _plan_key. Stored, sized and timed by
+  'plan_cache' in the config, built on first use like _tool_cache.
+  '''
+  return build_tool_cache(load_config()['plan_cache'], table="plans")
+
+
+@functools.cache
+def _tools_by_name() -> Dict[str, Any]:
+  return {tool.name: tool for tool in get_tools()}
 
 
 def _get_observations(messages: List[BaseMessage]) -> Dict[int, Any]:
-  # Get all previous tool responses
+  # Get all previous tool responses, keyed by task index. If an index shows up more than
+  # once, setdefault keeps the earliest message.
   results = {}
-  # Invert the list
-  # For each message, if it is a tool message, add it to the results
-  for message in messages[::-1]:
+  for message in messages:
     if isinstance(message, FunctionMessage):
-      results[int(message.additional_kwargs["idx"])] = message.content
-  # Return all instances of tool responses.
+      results.setdefault(int(message.additional_kwargs["idx"]), message.content)
   return results
 
 
+def _canonicalize_observation(observation: Any) -> str:
+  '''Turns a tool result into the content of its FunctionMessage. The same result always
+  gives the exact same string, so prompts built from these messages repeat byte for byte
+  across replans and provider prefix caches keep hitting.
+
+  Structured results, like the list of dicts the search tool returns, are dumped as JSON
+  with sorted keys. All text is NFC normalized and has trailing whitespace removed.
+  '''
+  if isinstance(observation, (list, dict)):
+    try:
+      text = json.dumps(
+        observation, sort_keys=True, separators=(',', ':'), ensure_ascii=False
+      )
+    except (TypeError, ValueError):
+      text = str(observation)
+  else:
+    text = str(observation)
+  return unicodedata.normalize("NFC", text).rstrip()
+
+
+class _ObservationStore:
+  '''Task results keyed by task index, shared between the worker threads.
+
+  Tasks write their result from whichever thread ran them while other tasks read the
+  results they depend on, so every access goes through a lock instead of relying on
+  single dict operations happening to be atomic.
+  '''
+
+  def __init__(self, initial: Optional[Dict[int, Any]] = None):
+    self._results: Dict[int, Any] = dict(initial or {})
+    self._lock = threading.Lock()
+
+  def __setitem__(self, idx: int, value: Any):
+    with self._lock:
+      self._results[idx] = value
+
+  def __getitem__(self, idx: int) -> Any:
+    with self._lock:
+      return self._results[idx]
+
+  def __contains__(self, idx: int) -> bool:
+    with self._lock:
+      return idx in self._results
+
+  def get(self, idx: int, default: Any = None) -> Any:
+    with self._lock:
+      return self._results.get(idx, default)
+
+  def keys(self) -> Set[int]:
+    # A snapshot, so callers can iterate or do set math while tasks are still writing.
+    with self._lock:
+      return set(self._results)
+
+
 class SchedulerInput(TypedDict):
   messages: List[BaseMessage]
   tasks: Iterable[Task]
@@ -42,14 +143,15 @@ class SchedulerInput(TypedDict):
 def _execute_task(task, observations, config):
   '''Execute a task with the given observations.'''
 
-  tool_to_use = task["tool"]
+  tool_to_use = task.tool
+  tool_name = task.tool_name
 
   # This is for the join() function. Just return and it will set the results as 'join'
   # and the agent will follow up by replanning.
-  if isinstance(tool_to_use, str):
+  if tool_name == "join":
     return tool_to_use
 
-  args = task["args"]
+  args = task.args
 
   try:
 
@@ -70,67 +172,80 @@ def _execute_task(task, observations, config):
 
   except Exception as e:
     return (
-      f"ERROR(Failed to call {tool_to_use.name} with args {args}.)"
-      f" Args could not be resolved. Error: {repr(e)}"
+      f"ERROR(Failed to call {tool_name} with args {args}.)"
+      f" Args could not be resolved. Error: {e!r}"
     )
 
+  # Replans often repeat a call the last plan already made, skip the tool if the result
+  # is cached.
+  cache_key = None
+  if is_cacheable(tool_to_use):
+    cache_key = make_key(tool_name, resolved_args)
+    cached = _tool_cache().get(cache_key)
+    if cached is not MISS:
+      return cached
+
   try:
-    return tool_to_use.invoke(resolved_args, config)
+    result = tool_to_use.invoke(resolved_args, config)
+    # Only successful results are cached, see is_error_result.
+    if cache_key is not None and not is_error_result(result):
+      _tool_cache().set(cache_key, result)
+    return result
 
   except Exception as e:
 
     return (
-      f"ERROR(Failed to call {tool_to_use.name} with args {args}."
-      + f" Args resolved to {resolved_args}. Error: {repr(e)})"
+      f"ERROR(Failed to call {tool_name} with args {args}."
+      f" Args resolved to {resolved_args}. Error: {e!r})"
     )
 
 
-def _resolve_arg(arg: Union[str, Any], observations: Dict[int, Any]):
-  '''Resolve arguments. This is mostly to get and replace ${idx} arguments that are
-  dependencies on other tasks. Otherwise we just return the arguments again.
+def _replace_match(observations: _ObservationStore, match: re.Match) -> str:
+  '''re.sub() callback for _resolve_arg, swaps an ${idx} placeholder for the result of
+  that task. Kept at module level so it isn't rebuilt on every call.
   '''
+  # If the string is ${123}, match.group(0) is ${123}, and match.group(1) is 123.
+
+  # Return the match group, in this case the index, from the string. This is the index
+  # number we get back.
+  idx = int(match.group(1))
+  # This expression retrieves the value associated with the index idx from the
+  # observations dictionary. If the index is not found in the dictionary, it returns
+  # the placeholder itself (match.group(0)).
+  return str(observations.get(idx, match.group(0)))
 
-  def replace_match(match):
-    # If the string is ${123}, match.group(0) is ${123}, and match.group(1) is 123.
 
-    # Return the match group, in this case the index, from the string. This is the index
-    # number we get back.
-    idx = int(match.group(1))
-    # This expression retrieves the value associated with the index idx from the
-    # observations dictionary. If the index is not found in the dictionary, it returns
-    # the placeholder itself (match.group(0)).
-    return str(observations.get(idx, match.group(0)))
+def _resolve_arg(arg: Union[str, Any], observations: _ObservationStore):
+  '''Resolve arguments. This is mostly to get and replace ${idx} arguments that are
+  dependencies on other tasks. Otherwise we just return the arguments again, unchanged.
+  '''
 
   # For dependencies on other tasks
   if isinstance(arg, str):
-    # re.sub() searches the whole string and replaces all occurrences where the pattern
+    # Most args don't reference another task, no '$' means there's nothing to replace
+    # so skip the regex scan entirely.
+    if "$" not in arg:
+      return arg
+    # sub() searches the whole string and replaces all occurrences where the pattern
     # is matched. For each match, it calls the function and uses the match as input,
     # then replaces the match with the returned value from the function.
-    return re.sub(ID_PATTERN, replace_match, arg)
+    return _ID_RE.sub(functools.partial(_replace_match, observations), arg)
 
   elif isinstance(arg, list):
     return [_resolve_arg(a, observations) for a in arg]
 
   else:
-    return str(arg)
+    # Numbers, bools, None, etc. can't hold a placeholder. Pass them through as is, the
+    # tools validate their args against their schemas and take native types.
+    return arg
 
 
-@as_runnable
-def schedule_task(task_inputs, config) -> None:
-  '''Schedule and run the task and update with results.
-
-  task_inputs is a dictionary and a mutable object in python, so it is being passed by
-  reference; this function will modify the object directly through the reference. So the
-  caller function will see results in the same object it passed in and this function
-  thus won't return any values.
+def _schedule_task(task: Task, observations: _ObservationStore, config) -> None:
+  '''Run the task and store its result in observations under the task's index.
 
-  The passed in observations will have a new entry inserted using the index of the task
-  as the key and the results of running the task as the value.
+  observations is shared with the scheduler and the other tasks, so this function writes
+  to it directly and doesn't return any values.
   '''
-
-  task: Task = task_inputs["task"]
-  observations: Dict[int, Any] = task_inputs["observations"]
-
   try:
     observation = _execute_task(task, observations, config)
 
@@ -140,121 +255,259 @@ def schedule_task(task_inputs, config) -> None:
     # the error.
     observation = e
 
-  # Mutable parameter passed by reference, so we don't need to return anything.
-  observations[task["idx"]] = observation
+  observations[task.idx] = observation
 
 
-def schedule_pending_task(
-  task: Task, observations: Dict[int, Any], retry_after: float = 0.2
-):
+class _DAGScheduler:
+  """Group the tasks into a DAG schedule.
+  Tasks are run as soon as they're ready, in topological order, as they're added:
+  - A task whose dependencies are all finished is submitted to the thread pool right
+    away.
+  - Any other task is parked, along with a count of the dependencies it's still waiting
+    on. When a task finishes, a callback counts down each task that depends on it and
+    submits the ones that reach zero.
+  Only tasks that can actually run take up a worker thread; nothing sits in the pool
+  waiting for its dependencies.
+
+  Tasks are fed in with add() as the planner streams them, then wait() blocks until all
+  of them have run. Adding tasks doesn't block, so it can be driven by a sync iterator
+  or from an async for loop.
+
+  We assume the LLM does not create cyclic dependencies. Dependencies on tasks that come
+  later in the plan are fine. If a task depends on an index that never runs, it is run
+  anyway once everything else is done, rather than waiting forever.
+  """
 
-  while True:
-    deps = task["dependencies"]
+  def __init__(self, messages: List[BaseMessage], config):
+    self.config = config
+    # If we are re-planning, we may have calls that depend on previous
+    # plans. Start with those.
+    self.observations = _ObservationStore(_get_observations(messages))
+    self.originals = self.observations.keys()
+    # Grab task names and args because once the tasks are handed to the thread pool, we
+    # lose each task except the last one to finish. Grabbing them when they're added,
+    # let's us keep this info after they all complete.
+    self.task_names: Dict[int, str] = {}
+    self.args_for_tasks: Dict[int, Any] = {}
+    # Indexes of this plan's tasks in the order the planner gave them, which is already
+    # ascending, so the results can be turned into messages without sorting.
+    self.new_indices: List[int] = []
+
+    # DAG bookkeeping. Completion callbacks run on the worker threads, so everything
+    # below is only touched while holding the lock. It's reentrant because a callback
+    # runs right away, in the submitting thread, if its task is already done when it's
+    # added.
+    self._lock = threading.RLock()
+    self._all_done = threading.Condition(self._lock)
+    # Indexes whose results are in
+    self._finished = set(self.originals)
+    # Parked tasks: index -> task
+    self._waiting: Dict[int, Task] = {}
+    # Parked tasks: index -> number of dependencies it's still waiting on
+    self._remaining_deps: Dict[int, int] = {}
+    # Dependency index -> indexes of the parked tasks waiting on it
+    self._dependents: Dict[int, List[int]] = defaultdict(list)
+    # Number of tasks submitted to the pool that haven't finished yet
+    self._in_flight = 0
+
+  def add(self, task: Task):
+    '''Runs the task now if its dependencies are done, otherwise parks it.'''
+    self.task_names[task.idx] = task.tool_name
+    self.args_for_tasks[task.idx] = task.args
+    if task.idx not in self.originals:
+      self.new_indices.append(task.idx)
+
+    with self._lock:
+      # Dependencies that are not yet completed (completed ones are in '_finished'), as
+      # a single set difference.
+      remaining = set(task.dependencies) - self._finished
+      if remaining:
+        # One or more tasks that this task depends on is not yet finished. Park it
+        # until they are.
+        self._waiting[task.idx] = task
+        self._remaining_deps[task.idx] = len(remaining)
+        for dep in remaining:
+          self._dependents[dep].append(task.idx)
+      else:
+        # No deps or all deps satisfied, can schedule now.
+        self._submit(task)
+
+  def wait(self):
+    '''Blocks until every added task has run.'''
+    with self._lock:
+      while True:
+        while self._in_flight:
+          self._all_done.wait()
+        if not self._waiting:
+          break
+        # Nothing is running but tasks are still parked, so they depend on indexes that
+        # were never planned. Run them anyway, their unresolved placeholders will show
+        # up in the results for the LLM to deal with.
+        stuck = list(self._waiting.values())
+        self._waiting.clear()
+        self._remaining_deps.clear()
+        self._dependents.clear()
+        for task in stuck:
+          self._submit(task)
+
+  def tool_messages(self) -> List[FunctionMessage]:
+    '''The results of this plan's tasks as FunctionMessages, in task order.'''
+    # Convert observations to new tool messages to add to the state
+    new_observations = {
+      k: (self.task_names[k], self.args_for_tasks[k], self.observations[k])
+      for k in self.new_indices
+    }
+
+    return [
+      FunctionMessage(
+        name=task_name,
+        content=_canonicalize_observation(observation),
+        additional_kwargs={'idx': k, 'args':task_args}
+      )
+      for k, (task_name, task_args, observation) in new_observations.items()
+    ]
+
+  def _submit(self, task: Task):
+    with self._lock:
+      self._in_flight += 1
+    # Call the task directly, there's no need for a Runnable per task. The scheduler's
+    # config is handed down so the tool runs still show up under this run when tracing.
+    future = _EXECUTOR.submit(_schedule_task, task, self.observations, self.config)
+    future.add_done_callback(lambda _: self._on_done(task.idx))
+
+  def _on_done(self, idx: int):
+    with self._lock:
+      self._finished.add(idx)
+      for dependent_idx in self._dependents.pop(idx, []):
+        if dependent_idx not in self._waiting:
+          continue
+        self._remaining_deps[dependent_idx] -= 1
+        if not self._remaining_deps[dependent_idx]:
+          del self._remaining_deps[dependent_idx]
+          self._submit(self._waiting.pop(dependent_idx))
+      # Ready dependents were submitted above, before this task stops counting as in
+      # flight, so the count can't drop to zero while there's still work to do.
+      self._in_flight -= 1
+      self._all_done.notify_all()
 
-    if deps and (any([dep not in observations for dep in deps])):
-      # Dependencies not yet satisfied
-      time.sleep(retry_after)
-      continue
 
-    schedule_task.invoke({"task": task, "observations": observations})
-    break
+@as_runnable
+def schedule_tasks(scheduler_input: SchedulerInput, config) -> List[FunctionMessage]:
+  '''Runs the tasks as a DAG, see _DAGScheduler, and returns their results as
+  FunctionMessages.
+  '''
+  scheduler = _DAGScheduler(scheduler_input["messages"], config)
+  for task in scheduler_input["tasks"]:
+    scheduler.add(task)
+  scheduler.wait()
+  return scheduler.tool_messages()
+
+
+def _plan_key(messages: List[BaseMessage]):
+  '''Cache key for the plan of a new question, or None when the plan shouldn't be
+  cached.
+
+  Only the first plan for a question is cached, when the conversation ends with the
+  user's message. Replans depend on the tool results and joiner feedback before them, so
+  they're always made fresh. The planner's tokens are streamed, and streamed LLM calls
+  don't go through the LLM cache, so without this a repeat question would pay for the
+  whole plan again.
+
+  The key is the conversation, with runs of whitespace collapsed, plus the names of the
+  tools the plan can use and the planner's fingerprint (model settings, prompts and tool
+  descriptions), so changing any of those doesn't replay plans made before the change.
+  '''
+  if not messages or not isinstance(messages[-1], HumanMessage):
+    return None
+  return make_key(
+    "plan",
+    {
+      "tools": sorted(_tools_by_name()),
+      "planner": planner_fingerprint(),
+      "messages": [
+        [message.type, " ".join(str(message.content).split())] for message in messages
+      ],
+    },
+  )
 
 
-@as_runnable
-def schedule_tasks(scheduler_input: SchedulerInput) -> List[FunctionMessage]:
-  """Group the tasks into a DAG schedule.
-  For streaming, we are making a few simplifying assumptions:
-  1. The LLM does not create cyclic dependencies.
-  2. That the LLM will not generate tasks with future dependencies.
-  If this ceases to be a good assumption, you can either
-  adjust to do a proper topological sort (not-stream)
-  or use a more complicated data structure
-  """
+def _task_to_dict(task: Task) -> Dict[str, Any]:
+  return {
+    "idx": task.idx,
+    "tool_name": task.tool_name,
+    "args": task.args,
+    "dependencies": task.dependencies,
+    "thought": task.thought,
+  }
 
-  tasks = scheduler_input["tasks"]
-  messages = scheduler_input["messages"]
-
-  # If we are re-planning, we may have calls that depend on previous
-  # plans. Start with those.
-  observations = _get_observations(messages)
-  task_names = {}
-  args_for_tasks = {}
-  originals = set(observations)
-  # ^^ We assume each task inserts a different key above to avoid race conditions.
-
-  # List for tasks that have dependencies on other steps, they'll be scheduled tasks.
-  futures = []
-  retry_after = 0.25  # Retry every quarter second
-
-  with ThreadPoolExecutor() as executor:
-    for task in tasks:
-      # Grab dependencies
-      deps = task["dependencies"]
-      # Grab task names and args because outside the thread pool executor, we lose each
-      # task except the last one to finish. Grabbing here, let's us keep this info after
-      # they all complete.
-      task_names[task["idx"]] = (
-        task["tool"] if isinstance(task["tool"], str) else task["tool"].name
-      )
-      args_for_tasks[task["idx"]] = (task["args"])
-
-      if (
-        # Check if dependencies and if any of them are not yet completed (completed
-        # ones show up in the observations list)
-        deps
-        # any([dep not in observations for dep in deps]) evaluates to True if at least
-        # one element in deps is not present in observations, and False otherwise.
-        and (any([dep not in observations for dep in deps]))
-      ):
-        # One or more tasks that this task depends on is not yet finished. So we shedule
-        # it to wait.
-        futures.append(
-          executor.submit(
-            schedule_pending_task, task, observations, retry_after
-          )
-        )
 
-      else:
-        # No deps or all deps satisfied, can schedule now.
-        schedule_task.invoke(input={"task": task, "observations": observations})
+def _task_from_dict(task: Dict[str, Any]) -> Task:
+  return Task(
+    idx=task["idx"],
+    tool="join" if task["tool_name"] == "join" else _tools_by_name()[task["tool_name"]],
+    tool_name=task["tool_name"],
+    args=task["args"],
+    dependencies=task["dependencies"],
+    thought=task["thought"],
+  )
 
-    # All tasks have been submitted or enqueued. Wait for them to complete.
-    wait(futures)
 
-  # Convert observations to new tool messages to add to the state
-  new_observations = {
-    k: (task_names[k], args_for_tasks[k], observations[k])
-    for k in sorted(observations.keys() - originals)
-  }
+def _cached_plan(plan_key) -> Optional[List[Task]]:
+  if plan_key is None:
+    return None
+  plan = _plan_cache().get(plan_key)
+  return None if plan is MISS else [_task_from_dict(task) for task in plan]
 
-  tool_messages = [
-    FunctionMessage(name=task_name, content=str(observation), additional_kwargs={'idx': k, 'args':task_args})
-    for k, (task_name, task_args, observation) in new_observations.items()
-  ]
 
-  return tool_messages
+def _cache_plan(plan_key, tasks: List[Task]):
+  # An empty plan is most likely a planner failure, don't keep replaying it.
+  if plan_key is not None and tasks:
+    _plan_cache().set(plan_key, [_task_to_dict(task) for task in tasks])
+
+
+def _recorded(tasks: Iterable[Task], plan_key) -> Iterator[Task]:
+  '''Passes the planner's tasks through as they stream in and caches the whole plan
+  once the stream is done.'''
+  planned = []
+  for task in tasks:
+    planned.append(task)
+    yield task
+  _cache_plan(plan_key, planned)
+
+
+def _prepend(head: Task, tail: Iterable[Task]) -> Iterable[Task]:
+  '''Put a task that was already pulled off the planner's stream back in front of it.'''
+  yield head
+  yield from tail
 
-@as_runnable
-def plan_and_schedule(messages: List[BaseMessage], config):
+
+def _plan_and_schedule(messages: List[BaseMessage], config):
 
   # Planner is a LangChain Runnable, in this case a chain that plans and returns tasks:
   # return (
   #   RunnableBranch(
-  #     (should_replan, wrap_and_get_last_index | replanner_prompt),
-  #     wrap_messages | planner_prompt,
+  #     (should_replan, wrap_and_get_last_index),
+  #     wrap_messages,
   #   )
-  #   | llm
+  #   | prompt
+  #   | llm.with_config(run_name="planner")
   #   | LLMCompilerPlanParser(tools=tools)
   # )
   # Planner returns a generator of tasks, meaning it's a lazy iterator. We will call
   # next() on it to kickstart the first task.
-  tasks = planner.stream(messages, config)
+  # A question that was already planned reuses its plan and skips the planner.
+  plan_key = _plan_key(messages)
+  cached_plan = _cached_plan(plan_key)
+  if cached_plan is not None:
+    return schedule_tasks.invoke({"messages": messages, "tasks": cached_plan}, config)
+
+  tasks = _recorded(get_planner().stream(messages, config), plan_key)
 
   # Get the first task which makes the lazy generator kickstart the first task, then
   # join it back now that the first task has started.
   try:
     first_task = next(tasks)
-    tasks = itertools.chain([first_task], tasks)
+    tasks = _prepend(first_task, tasks)
 
   except StopIteration:
     # Handle the case where 'tasks' is empty or has reached its end
@@ -271,6 +524,31 @@ def plan_and_schedule(messages: List[BaseMessage], config):
   return scheduled_tasks
 
 
+async def _aplan_and_schedule(messages: List[BaseMessage], config):
+  '''Async version of _plan_and_schedule. The planner's tokens are streamed on the
+  event loop and each task is handed to the scheduler the moment its line is parsed, so
+  the first tools start running while the rest of the plan is still being written.
+  Only the final wait for the tools to finish is moved off the event loop.
+  '''
+  scheduler = _DAGScheduler(messages, config)
+  plan_key = _plan_key(messages)
+  cached_plan = _cached_plan(plan_key)
+  if cached_plan is not None:
+    for task in cached_plan:
+      scheduler.add(task)
+  else:
+    planned = []
+    async for task in get_planner().astream(messages, config):
+      planned.append(task)
+      scheduler.add(task)
+    _cache_plan(plan_key, planned)
+  await asyncio.to_thread(scheduler.wait)
+  return scheduler.tool_messages()
+
+
+plan_and_schedule = RunnableLambda(_plan_and_schedule, afunc=_aplan_and_schedule)
+
+
 # Example:
 # example_question = "What's the temperature in SF raised to the 3rd power?"
 # tool_messages = plan_and_schedule.invoke([HumanMessage(content=example_question)])
@@ -0,0 +1,36 @@
+import functools
+import json
+from pathlib import Path
+
+# The compiler_agent directory. Files are found relative to this module instead of the
+# current working directory.
+_AGENT_DIR = Path(__file__).resolve().parent.parent
+
+
+@functools.cache
+def load_config() -> dict:
+  '''Reads and parses config.json. It is cached so the file is only read once per
+  interpreter, no matter how many modules ask for it. Worker processes forked after
+  the first load share the parsed result instead of reading the file again.
+
+  The returned dict is shared, treat it as read only.
+  '''
+  with open(_AGENT_DIR / 'config.json', 'r') as f:
+    return json.load(f)
+
+
+def resolve_path(path: str) -> str:
+  '''Resolves a path from the config, like a cache's 'database_path'. Relative paths
+  are relative to the compiler_agent directory, the same as the config and prompts, so
+  cache files end up in one place no matter which directory the agent is run from.
+  '''
+  return str(_AGENT_DIR / Path(path).expanduser())
+
+
+@functools.cache
+def load_prompt(name: str) -> str:
+  '''Reads a prompt file from the prompts directory, for example 'joiner_1.txt'. Each
+  file is read once per interpreter and the same string is returned after that.
+  '''
+  with open(_AGENT_DIR / 'prompts' / name, 'r') as file:
+    return file.read()
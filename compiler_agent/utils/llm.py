@@ -0,0 +1,143 @@
+import functools
+import os
+from typing import Any, Tuple
+
+from langchain_core.globals import set_llm_cache
+from langchain_core.language_models import BaseChatModel
+
+from utils.config import load_config, resolve_path
+
+
+def _build_llm_cache(cache_config: dict):
+  '''Builds the shared LLM response cache from the 'llm_cache' config section.
+  - 'sqlite': Local file, kept between runs. The default.
+  - 'memory': Kept in the process only, starts empty every run. Handy when testing.
+  - 'redis': Shared by every process pointed at the same Redis, set with 'redis_url'.
+    Needs the optional 'redis' package.
+  - 'none': No cache, every call goes to the API.
+  '''
+  cache_type = cache_config.get('type', 'sqlite')
+  if cache_type == 'none':
+    return None
+  # The cache classes are imported here, langchain_community is only loaded once an LLM
+  # is built.
+  if cache_type == 'memory':
+    from langchain_community.cache import InMemoryCache
+    return InMemoryCache()
+  if cache_type == 'redis':
+    # redis is optional, only needed for the Redis cache.
+    from redis import Redis
+    from langchain_community.cache import RedisCache
+    return RedisCache(redis_=Redis.from_url(cache_config['redis_url']))
+
+  from langchain_community.cache import SQLiteCache
+  return SQLiteCache(database_path=resolve_path(cache_config['database_path']))
+
+
+@functools.cache
+def _init_llm_cache():
+  '''Cache LLM responses for every model that doesn't set its own cache (the joiner has
+  its own, see 'joiner_cache'). Replans and repeated questions send the exact same
+  prompts, e.g. the math tool translating the same problem, and those are answered from
+  the cache instead of another round trip to the API. Every LLM is built by make_llm,
+  which calls this first, so the cache is in place before any calls are made.
+  '''
+  set_llm_cache(_build_llm_cache(load_config()['llm_cache']))
+
+
+# ChatOpenAI settings that configure the OpenAI client rather than the model. ChatOpenAI
+# only applies them when it builds its own clients, which it skips when it's handed the
+# shared ones, so they're applied here instead.
+# field name -> (alias ChatOpenAI also accepts, OpenAI client argument)
+_CLIENT_SETTINGS = {
+  "openai_api_key": ("api_key", "api_key"),
+  "openai_api_base": ("base_url", "base_url"),
+  "openai_organization": ("organization", "organization"),
+  "request_timeout": ("timeout", "timeout"),
+  "max_retries": (None, "max_retries"),
+  "default_headers": (None, "default_headers"),
+  "default_query": (None, "default_query"),
+  "openai_proxy": (None, None),
+}
+
+# Environment variables ChatOpenAI falls back to that the OpenAI client doesn't read.
+# The client reads OPENAI_API_KEY, OPENAI_BASE_URL and OPENAI_ORG_ID itself.
+_CLIENT_SETTINGS_ENV = {
+  "openai_api_base": "OPENAI_API_BASE",
+  "openai_organization": "OPENAI_ORGANIZATION",
+  "openai_proxy": "OPENAI_PROXY",
+}
+
+
+def _client_settings(llm_config: dict) -> Tuple[Tuple[str, Any], ...]:
+  '''The client settings from a config entry and the environment, as a sorted tuple so
+  it can key the client cache. Dicts, like default_headers, are turned into tuples of
+  their items.
+  '''
+  for key in ("http_client", "http_async_client", "client", "async_client"):
+    if key in llm_config:
+      raise ValueError(
+        f"'{key}' can't be set in an LLM config, the clients are built by make_llm."
+      )
+
+  settings = {}
+  for field, (alias, _) in _CLIENT_SETTINGS.items():
+    value = llm_config.get(field, llm_config.get(alias) if alias else None)
+    if value is None and field in _CLIENT_SETTINGS_ENV:
+      value = os.getenv(_CLIENT_SETTINGS_ENV[field]) or None
+    if value is None:
+      continue
+    if isinstance(value, dict):
+      value = tuple(sorted(value.items()))
+    settings[field] = value
+  return tuple(sorted(settings.items()))
+
+
+@functools.cache
+def _get_clients(settings: Tuple[Tuple[str, Any], ...]) -> Tuple[Any, Any]:
+  '''Creates the OpenAI clients for one set of client settings, once, on first use.
+  Every LLM with the same settings shares them. Each ChatOpenAI would otherwise open its
+  own connection pool, so the planner, joiner and math tool would each pay for their own
+  TCP/TLS handshakes. With one pool, connections are kept alive and reused across all of
+  them.
+
+  ChatOpenAI needs a sync and an async client, and httpx pools can't be shared between
+  the two, so there's one pool for each.
+  '''
+  # Imported here so the OpenAI SDK and httpx are only loaded once an LLM is built.
+  import httpx
+  import openai
+
+  client_args = {}
+  proxy = None
+  for field, value in settings:
+    if field == "openai_proxy":
+      proxy = value
+      continue
+    if field in ("default_headers", "default_query"):
+      value = dict(value)
+    client_args[_CLIENT_SETTINGS[field][1]] = value
+
+  limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+  client = openai.OpenAI(
+    http_client=httpx.Client(limits=limits, proxies=proxy), **client_args
+  )
+  async_client = openai.AsyncOpenAI(
+    http_client=httpx.AsyncClient(limits=limits, proxies=proxy), **client_args
+  )
+  return client.chat.completions, async_client.chat.completions
+
+
+def make_llm(**llm_config: Any) -> BaseChatModel:
+  '''Builds a ChatOpenAI from a config entry, e.g. make_llm(**config['planner_llm']),
+  using the shared clients for its client settings (API key, base URL, timeout, etc.).
+  Use this instead of creating ChatOpenAI directly.
+  '''
+  # Imported here, like the clients above, so importing this module stays cheap.
+  from langchain_openai import ChatOpenAI
+
+  _init_llm_cache()
+  client, async_client = _get_clients(_client_settings(llm_config))
+  # The settings are passed on too, ChatOpenAI still checks for an API key and keeps
+  # them as its own fields, it just doesn't build clients from them.
+  return ChatOpenAI(client=client, async_client=async_client, **llm_config)
@@ -2,9 +2,8 @@ import math
 import re
 from typing import List, Optional
 
-import numexpr
 from langchain.chains.openai_functions import create_structured_output_runnable
-from langchain_community.chat_models import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.pydantic_v1 import BaseModel, Field
@@ -99,6 +98,9 @@ Context:
 
 Note that context varibles are not defined in code yet. You must extract the relevant
 numbers and directly put them in code.'''
+# The context template split around its one placeholder, so the context can be dropped
+# in with a plain concatenation instead of running str.format() on every call.
+_CONTEXT_PREFIX, _CONTEXT_SUFFIX = _ADDITIONAL_CONTEXT_PROMPT.split("{context}")
 
 
 class ExecuteCode(BaseModel):
@@ -115,14 +117,30 @@ class ExecuteCode(BaseModel):
   )
 
 
+# Constants the expressions can use. numexpr only reads this, so one dict is shared by
+# every call.
+_LOCAL_DICT = {"pi": math.pi, "e": math.e}
+
+
+# Problems made only of numbers, arithmetic operators and parentheses, e.g. "32/4.23" or
+# "(3 + 4) ** 2", are already valid numexpr expressions. '^' is left out on purpose, in
+# numexpr it's XOR, not a power, so those go through the LLM to be translated.
+_PLAIN_EXPRESSION_RE = re.compile(r"[\d\s.+\-*/%()]+")
+
+
 def _evaluate_expression(expression: str) -> str:
+  # Imported on first use, numexpr is slow to import (it sets up its thread pool) and
+  # only the math tool needs it. After the first call this is just a module lookup.
+  import numexpr
+
+  # numexpr.evaluate() already keeps its own cache of compiled expressions, keyed by the
+  # expression text and argument types, so repeat expressions skip the parse and compile.
   try:
-    local_dict = {"pi": math.pi, "e": math.e}
     output = str(
       numexpr.evaluate(
         expression.strip(),
         global_dict={},  # restrict access to globals
-        local_dict=local_dict,  # add common mathematical functions
+        local_dict=_LOCAL_DICT,  # add common mathematical functions
       )
     )
   except Exception as e:
@@ -131,11 +149,16 @@ def _evaluate_expression(expression: str) -> str:
       " Please try again with a valid numerical expression"
     )
 
-  # Remove any leading and trailing brackets from the output
-  return re.sub(r"^\[|\]$", "", output)
+  # Remove any leading and trailing brackets from the output. Scalar results, the usual
+  # case, have none, so plain prefix/suffix checks are enough.
+  if output.startswith("["):
+    output = output[1:]
+  if output.endswith("]"):
+    output = output[:-1]
+  return output
 
 
-def get_math_tool(llm: ChatOpenAI):
+def get_math_tool(llm: BaseChatModel):
   prompt = ChatPromptTemplate.from_messages(
     [
       ("system", _SYSTEM_PROMPT),
@@ -150,6 +173,14 @@ def get_math_tool(llm: ChatOpenAI):
     context: Optional[List[str] | str] = None,
     config: Optional[RunnableConfig] = None,
   ):
+    # A plain arithmetic expression with no context doesn't need the LLM to translate it,
+    # evaluate it directly. If numexpr can't, the LLM still gets a go at it below.
+    if not context and _PLAIN_EXPRESSION_RE.fullmatch(problem):
+      try:
+        return _evaluate_expression(problem)
+      except ValueError:
+        pass
+
     chain_input = {"problem": problem}
     # If there's context append it to the prompt.
     if context:
@@ -160,11 +191,11 @@ def get_math_tool(llm: ChatOpenAI):
         context_str = context
 
       # If the context string is not empty after stripping it of whitespace
-      if context_str.strip():
-        context_str = _ADDITIONAL_CONTEXT_PROMPT.format(
-          context=context_str.strip()
-        )
-        chain_input["context"] = [SystemMessage(content=context_str)]
+      context_str = context_str.strip()
+      if context_str:
+        chain_input["context"] = [
+          SystemMessage(content=f"{_CONTEXT_PREFIX}{context_str}{_CONTEXT_SUFFIX}")
+        ]
     code_model = extractor.invoke(chain_input, config)
     try:
       return _evaluate_expression(code_model.code)
@@ -175,4 +206,6 @@ def get_math_tool(llm: ChatOpenAI):
     name="math",
     func=calculate_expression,
     description=_MATH_DESCRIPTION,
+    # No side effects, the same problem and context can reuse a previous answer.
+    metadata={"cacheable": True},
   )
\ No newline at end of file
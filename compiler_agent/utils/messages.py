@@ -0,0 +1,73 @@
+import functools
+from typing import TYPE_CHECKING, List
+
+from langchain_core.messages import BaseMessage
+
+if TYPE_CHECKING:
+  import tiktoken
+
+
+@functools.cache
+def _get_encoding(model: str) -> "tiktoken.Encoding":
+  '''Gets the tokenizer for a model, loaded once per model name. tiktoken is imported
+  here so it's only loaded once something actually needs counting.
+  '''
+  import tiktoken
+
+  try:
+    return tiktoken.encoding_for_model(model)
+  except KeyError:
+    # Model names tiktoken doesn't know yet, use the encoding of the GPT-4 family.
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(texts: List[str], model: str) -> int:
+  '''Total number of tokens in the texts for the model's tokenizer.'''
+  encoding = _get_encoding(model)
+  return sum(len(encoding.encode(text)) for text in texts)
+
+
+def trim_to_token_budget(
+  messages: List[BaseMessage], max_tokens: int, model: str, keep_last: bool = False
+) -> List[BaseMessage]:
+  '''Keeps the first message (the user's question) and as many of the most recent
+  messages as fit in max_tokens, counting only message content. Messages in the middle,
+  the oldest tool results and replan context, are dropped. Without this every replan
+  sends the whole history again and the prompt keeps growing.
+
+  Example with a small budget:
+  - HumanMessage(content="What's the GDP of New York?")  <- kept, the question
+  - FunctionMessage(...)                                 <- dropped
+  - AIMessage(content="Thought: ...")                    <- dropped
+  - SystemMessage(content="Context from last attempt: ...") <- kept
+  - FunctionMessage(...)                                 <- kept
+
+  With keep_last, the newest message is always kept as well, even if it doesn't fit,
+  e.g. the joiner's replan context that the replanner has to see.
+  '''
+  if len(messages) <= 2:
+    return messages
+
+  contents = [str(message.content) for message in messages]
+  # The tokenizer is byte level BPE, every token is at least one UTF-8 byte, so if all
+  # the text is fewer bytes than the budget there's no need to run the tokenizer at all.
+  # Characters aren't a bound, CJK text and emoji are often 2-3 tokens per character.
+  if sum(len(content.encode("utf-8")) for content in contents) <= max_tokens:
+    return messages
+
+  encoding = _get_encoding(model)
+  budget = max_tokens - len(encoding.encode(contents[0]))
+  start = len(messages)
+  if keep_last:
+    budget -= len(encoding.encode(contents[-1]))
+    start -= 1
+  # Walk back from the newest message until the budget runs out.
+  while start > 1:
+    budget -= len(encoding.encode(contents[start - 1]))
+    if budget < 0:
+      break
+    start -= 1
+
+  if start == 1:
+    return messages
+  return [messages[0]] + messages[start:]
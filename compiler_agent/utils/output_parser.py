@@ -1,12 +1,16 @@
 import ast
+import copy
+import functools
 import re
+from dataclasses import dataclass
 from typing import (
   Any,
+  AsyncIterator,
   Dict,
   Iterator,
   List,
+  NamedTuple,
   Optional,
-  Sequence,
   Tuple,
   Union
 )
@@ -14,84 +18,124 @@ from typing import (
 from langchain_core.exceptions import OutputParserException
 from langchain_core.messages import BaseMessage
 from langchain_core.output_parsers.transform import BaseTransformOutputParser
+from langchain_core.pydantic_v1 import PrivateAttr
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import BaseTool
-from typing_extensions import TypedDict
 
 THOUGHT_PATTERN = r"Thought: ([^\n]*)"
-ACTION_PATTERN = r"\n*(\d+)\. (\w+)\((.*)\)(\s*#\w+\n)?"
-# $1 or ${1} -> 1
-ID_PATTERN = r"\$\{?(\d+)\}?"
+# Lines are split on newlines before they're matched, so there are no newlines to allow
+# for around an action.
+ACTION_PATTERN = r"(\d+)\. (\w+)\((.*)\)(\s*#\w+)?"
 END_OF_PLAN = "<END_OF_PLAN>"
 
+# Compiled once here, they run for every streamed line and every parsed task.
+_THOUGHT_RE = re.compile(THOUGHT_PATTERN)
+_ACTION_RE = re.compile(ACTION_PATTERN)
+
 
 ### Helper functions
 
-def _ast_parse(arg: str) -> Any:
+def _chunk_text(chunk: Union[str, BaseMessage]) -> str:
+  '''Text of a streamed chunk. Message content is almost always already a str, only
+  call str() when it isn't.
+  '''
+  if isinstance(chunk, str):
+    return chunk
+  return chunk.content if isinstance(chunk.content, str) else str(chunk.content)
+
+
+# Plans repeat the same literal args a lot, across tasks and across replans, so parsed
+# values are cached by their raw string.
+@functools.lru_cache(maxsize=1024)
+def _literal_eval(arg: str) -> Any:
   try:
     return ast.literal_eval(arg)
   except:  # noqa
     return arg
 
 
-def _parse_llm_compiler_action_args(args: str, tool: Union[str, BaseTool]) -> list[Any]:
-  """Parse arguments from a string."""
+def _ast_parse(arg: str) -> Any:
+  '''Parses an arg's literal value, or returns the raw string if it isn't one. The
+  cache hands back the same object on every hit, so lists, dicts and other containers
+  are copied before they're returned. Otherwise a change to one task's args would show
+  up in every later parse of the same text. Strings and numbers are immutable and are
+  returned as is.
+  '''
+  value = _literal_eval(arg)
+  if isinstance(value, (list, dict, set, tuple)):
+    return copy.deepcopy(value)
+  return value
+
+
+def _parse_llm_compiler_action_args(
+  args: str,
+  tool: Union[str, BaseTool],
+  arg_keys: Tuple[Tuple[str, str], ...],
+  ) -> Dict[str, Any]:
+  """Parse arguments from a string.
 
+  arg_keys holds (key, "key=") for each of the tool's args, worked out once per tool by
+  the parser instead of on every call.
+  """
+
+  # Always a dict, even when there's nothing to parse, so callers don't have to deal
+  # with two types.
   if args == "":
-    return ()
+    return {}
 
   if isinstance(tool, str):
-    return ()
+    return {}
 
   extracted_args = {}
+  # The key whose value starts at the front of 'args', once one has been found
   tool_key = None
-  prev_idx = None
-
-  for key in tool.args.keys():
-    # Split if present
-    if f"{key}=" in args:
-      idx = args.index(f"{key}=")
-      if prev_idx is not None:
-        extracted_args[tool_key] = _ast_parse(
-          args[prev_idx:idx].strip().rstrip(",")
-        )
-
-      args = args.split(f"{key}=", 1)[1]
-      tool_key = key
-      prev_idx = 0
-
-  if prev_idx is not None:
-    extracted_args[tool_key] = _ast_parse(
-      args[prev_idx:].strip().rstrip(",").rstrip(")")
-    )
-
-  return extracted_args
 
+  for key, key_eq in arg_keys:
+    # Split if present. partition() finds and splits in one pass, everything before
+    # "key=" is the previous key's value and everything after is what's left to parse.
+    head, sep, tail = args.partition(key_eq)
+    if sep:
+      if tool_key is not None:
+        extracted_args[tool_key] = _ast_parse(head.strip().rstrip(","))
 
-def default_dependency_rule(idx, args: str) -> bool:
-  '''Checks to see if the given index is listed as a dependency in the args string.
+      args = tail
+      tool_key = key
 
-  Uses regex to find all instances of the ID_PATTERN in the args string. This pulls out
-  numbers that are formatted to show dependencies.
-  Example regex matching: $1 or ${1} -> 1
+  if tool_key is not None:
+    extracted_args[tool_key] = _ast_parse(args.strip().rstrip(",").rstrip(")"))
 
-  Then, for all matches it finds, it checks if the index (idx) passed in is in the list.
+  return extracted_args
 
-  For example, if the args string is "query=$1, $2, $3" and idx is 2, then this function
-  will return True.
 
-  Purpose is for another function to use this to find when the current index is one of
-  the dependencies so that it can be removed from a list of dependencies.
+def _extract_dep_ids(args: str) -> set[int]:
+  '''Get every task index referenced in the args string. A task is referenced as $1 or
+  ${1} -> 1.
 
+  Finds each '$', skips an optional '{' and reads the digits after it. A '$' with no
+  digits after it isn't a reference and is skipped.
   '''
-  matches = re.findall(ID_PATTERN, args)
-  numbers = [int(match) for match in matches]
-  return idx in numbers
+  ids = set()
+  end = len(args)
+  pos = args.find("$")
+  while pos != -1:
+    start = pos + 1
+    if start < end and args[start] == "{":
+      start += 1
+    stop = start
+    # isdecimal() matches the same characters as the regex's \d
+    while stop < end and args[stop].isdecimal():
+      stop += 1
+    if stop > start:
+      ids.add(int(args[start:stop]))
+      pos = args.find("$", stop)
+    else:
+      pos = args.find("$", pos + 1)
+  return ids
 
 
 def _get_dependencies_from_graph(
   idx: int, tool_name: str, args: Dict[str, Any]
-  ) -> dict[str, list[str]]:
+  ) -> List[int]:
   '''Get dependencies from a graph.'''
 
   # If the tool is 'join', that's a special case. It's an internal tool that was not one
@@ -100,20 +144,38 @@ def _get_dependencies_from_graph(
     # depends on the previous step
     return list(range(1, idx))
 
-  # define dependencies based on the dependency rule in default_dependency_rule
-  return [i for i in range(1, idx) if default_dependency_rule(i, str(args))]
+  # No args, nothing to reference. Skips the str() and the scan for tools called with ().
+  if not args:
+    return []
 
+  # Only earlier tasks count, and there are usually only one or two references, so sort
+  # those rather than walking every index below idx.
+  return sorted(i for i in _extract_dep_ids(str(args)) if 1 <= i < idx)
 
-class Task(TypedDict):
-  idx: int
+
+class _ToolEntry(NamedTuple):
   tool: BaseTool
-  args: list
-  dependencies: Dict[str, list]
+  # (key, "key=") for each of the tool's args, in order
+  arg_keys: Tuple[Tuple[str, str], ...]
+
+
+# A slotted dataclass rather than a dict, plans can hold many tasks and the scheduler
+# reads these fields for every one of them.
+@dataclass(slots=True)
+class Task:
+  idx: int
+  # The tool, or the string "join" for the join task
+  tool: Union[str, BaseTool]
+  # The tool's name, "join" for the join task. Set once here so the scheduler doesn't
+  # have to work it out from 'tool' for every task.
+  tool_name: str
+  args: Dict[str, Any]
+  dependencies: List[int]
   thought: Optional[str]
 
 
 def instantiate_task(
-  tools: Sequence[BaseTool],
+  tools_by_name: Dict[str, _ToolEntry],
   idx: int,
   tool_name: str,
   args: Union[str, Any],
@@ -124,25 +186,24 @@ def instantiate_task(
   # of the ones in the tools.py file or passed in the tools argument to the planner.
   if tool_name == "join":
     tool = "join"
+    arg_keys = ()
 
-  # Look for the tool in the tools list
+  # Look for the tool by name. The parser builds the name -> tool dict once, so this is
+  # a single lookup instead of searching the tools list for every task.
   else:
-    try:
-      # Get the tool names in a list. Then, get the index of the tool_name we're looking
-      # for. Finally, using the index we found, use that index to index into the tools
-      # list to get out the tool we're looking for.
-      tool = tools[[tool.name for tool in tools].index(tool_name)]
-
-    except ValueError as e:
-      raise OutputParserException(f"Tool {tool_name} not found.") from e
+    entry = tools_by_name.get(tool_name)
+    if entry is None:
+      raise OutputParserException(f"Tool {tool_name} not found.")
+    tool, arg_keys = entry
 
   # Parse args and dependencies
-  tool_args = _parse_llm_compiler_action_args(args, tool)
+  tool_args = _parse_llm_compiler_action_args(args, tool, arg_keys)
   dependencies = _get_dependencies_from_graph(idx, tool_name, tool_args)
 
   return Task(
     idx=idx,
     tool=tool,
+    tool_name=tool_name,
     args=tool_args,
     dependencies=dependencies,
     thought=thought
@@ -153,6 +214,16 @@ class LLMCompilerPlanParser(BaseTransformOutputParser[dict], extra="allow"):
   """Planning output parser."""
 
   tools: List[BaseTool]
+  _tools_by_name: Dict[str, _ToolEntry] = PrivateAttr(default_factory=dict)
+
+  def __init__(self, **kwargs: Any):
+    super().__init__(**kwargs)
+    # Each tool's arg schema and the "key=" strings searched for when parsing its args
+    # are the same for every task, so they're worked out once here.
+    self._tools_by_name = {
+      tool.name: _ToolEntry(tool, tuple((key, f"{key}=") for key in tool.args))
+      for tool in self.tools
+    }
 
   def _transform(self, input: Iterator[Union[str, BaseMessage]]) -> Iterator[Task]:
     '''processes a task list in the following form:
@@ -175,13 +246,13 @@ class LLMCompilerPlanParser(BaseTransformOutputParser[dict], extra="allow"):
     thought = None
     for chunk in input:
       # Assume input is str. TODO: support vision/other formats
-      text = chunk if isinstance(chunk, str) else str(chunk.content)
+      text = _chunk_text(chunk)
       # Example partial text:
       # - texts: ['', '0', '.', ' tav']
       # - text: 'ily'
       # Example complete text:
       # - texts: ['', '0', '.', ' tav', 'ily', '_search', '_results', '_json', '(query', '="', 'G', 'DP', ' of', ' New', ' York', '")', '']
-      # - returned task: {'idx': 0, 'tool': TavilySearchResults(description='tavily_search_results_json(query="the search query") - a search engine.', max_results=1), 'args': {'query': 'GDP of New York'}, 'dependencies': [], 'thought': None}
+      # - returned task: Task(idx=0, tool=TavilySearchResults(description='tavily_search_results_json(query="the search query") - a search engine.', max_results=1), tool_name='tavily_search_results_json', args={'query': 'GDP of New York'}, dependencies=[], thought=None)
       # - thought (or '_' as we set it here since we're not using it): None
       # Notes:
       # - ingest_token calls _parse_task internally
@@ -198,11 +269,31 @@ class LLMCompilerPlanParser(BaseTransformOutputParser[dict], extra="allow"):
       task, _ = self._parse_task("".join(texts), thought)
       # Example:
       # - texts: ['', '0', '.', ' tav', 'ily', '_search', '_results', '_json', '(query', '="', 'G', 'DP', ' of', ' New', ' York', '")', '']
-      # - returned task: {'idx': 0, 'tool': TavilySearchResults(description='tavily_search_results_json(query="the search query") - a search engine.', max_results=1), 'args': {'query': 'GDP of New York'}, 'dependencies': [], 'thought': None}
+      # - returned task: Task(idx=0, tool=TavilySearchResults(description='tavily_search_results_json(query="the search query") - a search engine.', max_results=1), tool_name='tavily_search_results_json', args={'query': 'GDP of New York'}, dependencies=[], thought=None)
       # - thought (or '_' as we set it here since we're not using it): None
       if task:
         yield task
 
+  async def _atransform(
+    self, input: AsyncIterator[Union[str, BaseMessage]]
+  ) -> AsyncIterator[Task]:
+    '''Async version of _transform, used by astream/ainvoke. The parser's default
+    async path would parse every chunk on its own, this buffers tokens into lines the
+    same way _transform does.
+    '''
+    texts = []
+    thought = None
+    async for chunk in input:
+      for task, thought in self.ingest_token(
+        token=_chunk_text(chunk), buffer=texts, thought=thought
+      ):
+        yield task
+
+    if texts:
+      task, _ = self._parse_task("".join(texts), thought)
+      if task:
+        yield task
+
   def parse(self, text: str) -> List[Task]:
     ''''''
     return list(self._transform([text]))
@@ -229,19 +320,32 @@ class LLMCompilerPlanParser(BaseTransformOutputParser[dict], extra="allow"):
     and clear the buffer to remove it and parsing can continue.
     '''
 
-    buffer.append(token)
+    # No newline, the current line isn't finished yet. Just buffer the token.
+    if "\n" not in token:
+      buffer.append(token)
+      return
 
     # If there's a newline, check if the buffer holds a task, meaning there might be
     # multiple tasks, one on each line. We can yield the task and clear it from the
     # buffer and return to allow parsing to continue.
-    if "\n" in token:
-      buffer_ = "".join(buffer).split("\n")
-      suffix = buffer_[-1]
-      for line in buffer_[:-1]:
-        task, thought = self._parse_task(line, thought)
-        if task:
-          yield task, thought
+    # The buffer never holds a newline, it's only ever the line in progress, so only the
+    # part of the token up to its last newline has to be joined on and split. Whatever
+    # comes after that newline starts the next line.
+    completed, _, suffix = token.rpartition("\n")
+    # Nothing buffered is the common case, the token itself holds the finished lines.
+    if buffer:
+      buffer.append(completed)
+      completed = "".join(buffer)
       buffer.clear()
+    # Most tokens hold at most one newline, so skip building a list when there's only
+    # the one line to parse.
+    lines = completed.split("\n") if "\n" in completed else (completed,)
+    for line in lines:
+      task, thought = self._parse_task(line, thought)
+      if task:
+        yield task, thought
+    # Tokens often end right at the newline, don't keep an empty string around to join.
+    if suffix:
       buffer.append(suffix)
 
   def _parse_task(self, line: str, thought: Optional[str] = None):
@@ -278,17 +382,22 @@ class LLMCompilerPlanParser(BaseTransformOutputParser[dict], extra="allow"):
 
     task = None
 
-    if match := re.match(THOUGHT_PATTERN, line):
+    # Cheap checks on the start of the line first, most streamed lines are neither a
+    # thought nor an action and never need to reach the regex. Neither pattern allows
+    # leading whitespace, so the line isn't stripped.
+    if line.startswith("Thought: ") and (match := _THOUGHT_RE.match(line)):
       # Optionally, action can be preceded by a thought
       thought = match.group(1)
 
-    elif match := re.match(ACTION_PATTERN, line):
+    # The matched tool name is looked up in _tools_by_name by instantiate_task, which
+    # raises for unknown tools.
+    elif line[:1].isdigit() and (match := _ACTION_RE.match(line)):
       # if action is parsed, return the task, and clear the buffer
       idx, tool_name, args, _ = match.groups()
       idx = int(idx)
 
       task = instantiate_task(
-        tools=self.tools,
+        tools_by_name=self._tools_by_name,
         idx=idx,
         tool_name=tool_name,
         args=args,
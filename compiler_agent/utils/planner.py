@@ -1,55 +1,125 @@
-from typing import Sequence
+import functools
+import hashlib
 import json
+import logging
+from typing import List, Optional, Sequence
 
 from langchain_core.language_models import BaseChatModel
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableBranch
 from langchain_core.tools import BaseTool
-from langchain_core.messages import FunctionMessage, SystemMessage
+from langchain_core.messages import FunctionMessage, HumanMessage, SystemMessage
 from langchain_core.prompts.chat import MessagesPlaceholder
 from langchain_core.prompts.chat import SystemMessagePromptTemplate
 
-from utils.output_parser import LLMCompilerPlanParser
-from langchain_openai import ChatOpenAI
-from utils.tools import tools
+from utils.config import load_config, load_prompt
+from utils.llm import make_llm
+from utils.messages import count_tokens, trim_to_token_budget
+from utils.output_parser import LLMCompilerPlanParser, Task
+from utils.tools import get_tools
 
 
+logger = logging.getLogger(__name__)
+
 # Read config file
-with open('compiler_agent/config.json', 'r') as f:
-  config = json.load(f)
+config = load_config()
+
+# The conversation always gets at least this many tokens, even when the prompt's own
+# instructions take up most of 'planner_max_tokens' or more.
+_MIN_HISTORY_TOKENS = 1000
+
+# Added after the replan context to tell the planner where to pick up numbering tasks.
+# The instructions that never change are in replan.txt, which is part of the system
+# prompt, so only this one short line differs between replans.
+_NEXT_TASK_INDEX_TEMPLATE = "- The index to continue from in your new action plan is: {next_task_index}"
+
+
+# Read replan instructions from local file. They never change, so this is done once at
+# import rather than every time a planner is created.
+replan_prompt = load_prompt('replan.txt')
 
-def create_planner(
-  llm: BaseChatModel,
-  tools: Sequence[BaseTool],
-  base_prompt: ChatPromptTemplate
-):
-  '''This function creates a planner'''
 
-  # Create a string of the tools and their descriptions
-  tool_descriptions = "\n".join(
-    f"{i+1}. {tool.description}\n" # +1 to offset the 0 starting index, we want it count normally from 1.
+def _compact_description(description: str) -> str:
+  '''A tool description with trailing whitespace and blank lines removed. These are
+  sent to the planner on every call, and the blank lines and trailing spaces cost tokens
+  without telling the LLM anything. Indents are kept, they show the structure of lists
+  and examples.
+  '''
+  return "\n".join(line.rstrip() for line in description.strip().splitlines() if line.strip())
+
+
+def describe_tools(tools: Sequence[BaseTool]) -> str:
+  '''Create a string of the tools and their descriptions, numbered from 1, one after the
+  other with no blank lines between them.'''
+  return "\n".join(
+    f"{i+1}. {_compact_description(tool.description)}" # +1 to offset the 0 starting index, we want it count normally from 1.
     for i, tool in enumerate(tools)
   )
 
-  # Create the general planner prompt that doesn't have the replan instructions inserted
-  # Take the base prompt and add the number of tools and their descriptions
-  planner_prompt = base_prompt.partial(
-    replan="",
+
+def _tool_prompt(base_prompt: ChatPromptTemplate, tools: Sequence[BaseTool]):
+  '''Take the base prompt and add the number of tools and their descriptions. Planning
+  and replanning use this same prompt, only {replan} differs between them, so it's
+  passed in with the messages: empty when planning and the replan instructions when
+  replanning.
+  '''
+  return base_prompt.partial(
     num_tools=len(tools)+1,# add one because we're adding the join() tool at the end.
-    tool_descriptions=tool_descriptions,
+    tool_descriptions=describe_tools(tools),
   )
 
-  # Read joiner prompt from local file
-  with open('compiler_agent/prompts/replan.txt', 'r') as file:
-    replan_prompt = file.read()
 
-  # Create the replanner prompt that has the replan instructions inserted
-  # Take the base prompt and add the number of tools and their descriptions and the replan instructions
-  replanner_prompt = base_prompt.partial(
-    replan=replan_prompt,
-    num_tools=len(tools)+1,# add one because we're adding the join() tool at the end.
-    tool_descriptions=tool_descriptions,
-  )
+def _static_contents(prompt: ChatPromptTemplate, replan: str) -> List[str]:
+  '''The text of the prompt with no messages in it, the part that's the same on every
+  call, one string per message.'''
+  return [str(message.content) for message in prompt.format_messages(messages=[], replan=replan)]
+
+
+def create_planner(
+  llm: BaseChatModel,
+  tools: Sequence[BaseTool],
+  base_prompt: ChatPromptTemplate,
+  max_prompt_tokens: Optional[int] = None
+):
+  '''This function creates a planner
+
+  If max_prompt_tokens is set, the conversation passed to the prompt is cut down to
+  the question plus the newest messages that fit in what's left of that many tokens
+  after the prompt's own instructions, so the prompt doesn't keep growing with every
+  replan. The graph's state itself keeps everything.
+  '''
+  # Used to pick the tokenizer when trimming, unknown models fall back to the GPT-4 one
+  model_name = getattr(llm, "model_name", "")
+
+  @functools.cache
+  def static_tokens(replan: str) -> int:
+    # The tokens the prompt takes up with no messages in it. That part never changes, so
+    # it's only tokenized the first time for planning and for replanning. It's done on
+    # first use rather than here so creating the planner doesn't load the tokenizer.
+    tokens = count_tokens(_static_contents(prompt, replan), model=model_name)
+    # Cached, so this is only logged once for planning and once for replanning.
+    if tokens >= max_prompt_tokens:
+      logger.warning(
+        "The planner's %s prompt is %d tokens before any messages, which is over the"
+        " %d token limit. The conversation is trimmed to %d tokens.",
+        "replan" if replan else "plan", tokens, max_prompt_tokens, _MIN_HISTORY_TOKENS
+      )
+    return tokens
+
+  def trim_history(state: list, replan: str) -> list:
+    if max_prompt_tokens is None:
+      return state
+    return trim_to_token_budget(
+      state,
+      max_tokens=max(max_prompt_tokens - static_tokens(replan), _MIN_HISTORY_TOKENS),
+      model=model_name,
+      # When replanning the last message is the joiner's context from the last attempt,
+      # the replanner has to see it no matter what else gets dropped.
+      keep_last=bool(replan)
+    )
+
+  # Each branch below passes {replan} in with the messages.
+  prompt = _tool_prompt(base_prompt, tools)
 
   def should_replan(state: list):
     '''
@@ -79,12 +149,13 @@ def create_planner(
     - SystemMessage(content='Context from last attempt: The information provided does not include the specific GDP value for New York. A different source or a direct visit to the provided URL might be necessary to obtain the exact GDP figure.\n- The index for the next task or tasks you create is: 1')
     - AIMessage(content="I was unable to find the specific Gross Domestic Product (GDP) figure for New York. You might want to check the latest statistics on reputable economic or governmental websites for the most current information.")
     '''
-    # Context is passed as a system message
-    return isinstance(state[-1], SystemMessage)
+    # Context is passed as a system message, which the joiner stamps with the 'replan'
+    # route, so the decision is read straight off the message.
+    return state[-1].additional_kwargs.get("route") == "replan"
 
-  # Wrap the messages in a dictionary for state passing
+  # Wrap the messages in a dictionary for state passing, no replan instructions
   def wrap_messages(state: list):
-    return {"messages": state}
+    return {"messages": trim_history(state, ""), "replan": ""}
 
   def wrap_and_get_last_index(state: list):
     next_task_index = 0
@@ -92,9 +163,9 @@ def create_planner(
     # are results from function calls that are passed back) and get the index. This
     # gives us the index of the last function called. We can then add 1 to set for the
     # next task we will be creating
-    # Note: state[::-1] means start at the end of the sequence and step backwards
-    # until you reach the start. This effectively reverses the sequence.
-    for message in state[::-1]:
+    # Note: reversed(state) steps backwards from the end of the list without making a
+    # reversed copy of it.
+    for message in reversed(state):
       if isinstance(message, FunctionMessage):
         # +1 because we want the next task to start after the last run function.
         next_task_index = message.additional_kwargs["idx"] + 1
@@ -117,56 +188,58 @@ def create_planner(
     '''
 
     '''
-    Append to the last message what index the next task needs to have.
+    Add a message after the last one saying what index the next task needs to have.
+    The messages in the state are left alone, so the replan context isn't changed in
+    the graph's state and the directive can't pile up if this runs again on the same
+    state.
     Example:
-    The last message, that's being accessed in the line below, will change to (using the example above):
+    The messages passed to the prompt end with (using the example above):
     - SystemMessage(content='Context from last attempt: The information provided does not include the specific GDP
     value for NY. A different source or a direct visit to the provided URL might be necessary to obtain the exact GDP
-    figure.
-    - From the previous attempt information, thought and context, create a new plan to solve
-      the user's query with the utmost parallelizability.
-    - You must continue the task index from the end of the previous one. Do not repeat task
-      indices.
-    - The index to continue from in your new action plan is: 3')
+    figure.')
+    - SystemMessage(content='- The index to continue from in your new action plan is: 1')
     '''
-    state[-1].content = state[-1].content + f'''
-- From the previous attempt information, thought and context, create a new plan to solve
-  the user's query with the utmost parallelizability.
-- You must continue the task index from the end of the previous one. Do not repeat task
-  indices.
-- The index to continue from in your new action plan is: {next_task_index}'''
-    return {"messages": state}
+    next_task_message = SystemMessage(
+      content=_NEXT_TASK_INDEX_TEMPLATE.format(next_task_index=next_task_index)
+    )
+    # The index is looked up on the full state above, only what's sent is trimmed.
+    return {
+      "messages": [*trim_history(state, replan_prompt), next_task_message],
+      "replan": replan_prompt
+    }
 
   return (
-    # Branching logic that determines which prompt we use: planner or replanner.
+    # Branching logic that determines the prompt's inputs: planning or replanning.
     # Each branch is a tuple of (condition, action). The first condition that
     # returns True will be the branch that is executed. The final branch is not a
     # tuple, and is the default action to take if none of the conditions return
     # True.
     RunnableBranch(
-      # How to read this: should_replan, (wrap_and_get_last_index | replanner_prompt)
-      # Call should_replan(), if it returns True, then call
-      # wrap_and_get_last_index() and use the output to map to the
-      # replanner_prompt. The | character is a special LangChain LCEL operator
-      # that connects actions.
-      (should_replan, wrap_and_get_last_index | replanner_prompt),
-      # Default action to take: (wrap_messages | planner_prompt) -> this is one
-      # action to take, even though it looks like two. The | character is a
-      # special LangChain LCEL operator that connects the two.
-      wrap_messages | planner_prompt,
+      # How to read this: call should_replan(), if it returns True, then call
+      # wrap_and_get_last_index() to get the messages with the replan instructions.
+      (should_replan, wrap_and_get_last_index),
+      # Default action to take: the messages without replan instructions.
+      wrap_messages,
     )
-    | llm
+    # Either branch's output is rendered by the one prompt. The | character is a
+    # special LangChain LCEL operator that connects actions.
+    | prompt
+    # Named so the planner's LLM call is easy to find in traces next to the joiner's and
+    # the math tool's, which use the same client.
+    | llm.with_config(run_name="planner")
     | LLMCompilerPlanParser(tools=tools)
   )
 
 
 # Read planner prompt from local file
-with open('compiler_agent/prompts/planner_1.txt', 'r') as file:
-  planner_prompt_1 = file.read()
-with open('compiler_agent/prompts/planner_2.txt', 'r') as file:
-  planner_prompt_2 = file.read()
+planner_prompt_1 = load_prompt('planner_1.txt')
+planner_prompt_2 = load_prompt('planner_2.txt')
 
-# Since this one has input variables, it is set separately
+# Since this one has input variables, it is set separately. Everything in it is the same
+# on every call except {replan}, which is at the very end. That keeps the tool
+# descriptions, guidelines and examples a byte for byte identical prefix for the plan and
+# replan prompts alike, which is what provider prompt caching (automatic on OpenAI for
+# long enough prefixes) matches on. The conversation comes after it.
 planner_prompt_template_1 = SystemMessagePromptTemplate.from_template(template=planner_prompt_1)
 
 planner_prompt = ChatPromptTemplate.from_messages(
@@ -176,16 +249,68 @@ planner_prompt = ChatPromptTemplate.from_messages(
     SystemMessage(content=planner_prompt_2)
   ]
 )
-# Example
-llm = ChatOpenAI(**config['planner_llm'])
 
-# This is the primary "agent" in our application
-planner = create_planner(llm, tools, planner_prompt)
+
+@functools.cache
+def get_planner():
+  '''This is the primary "agent" in our application. It's built on first use and the
+  same planner is returned after that, so importing this module doesn't build the LLM
+  or the tools.
+  '''
+  return create_planner(
+    make_llm(**config['planner_llm']),
+    get_tools(),
+    planner_prompt,
+    max_prompt_tokens=config['planner_max_tokens']
+  )
+
+
+@functools.cache
+def planner_fingerprint() -> str:
+  '''A hash of everything other than the conversation that decides what the planner
+  writes: its model settings, the full static prompt for planning and for replanning
+  (tool descriptions included), the next index directive and the tools' args. Cached
+  plans are keyed on it, so editing a prompt file, switching 'planner_llm' or changing
+  a tool makes the old plans miss instead of being replayed.
+  '''
+  tools = get_tools()
+  prompt = _tool_prompt(planner_prompt, tools)
+  settings = {
+    "llm": config['planner_llm'],
+    "plan": _static_contents(prompt, ""),
+    "replan": _static_contents(prompt, replan_prompt),
+    "next_task_index": _NEXT_TASK_INDEX_TEMPLATE,
+    "tool_args": {tool.name: tool.args for tool in tools},
+  }
+  return hashlib.sha256(
+    json.dumps(settings, sort_keys=True, default=str).encode()
+  ).hexdigest()
+
+
+async def plan_many(questions: List[str], max_concurrency: int = 16) -> List[List[Task]]:
+  '''Plans several questions at once, e.g. for evals or benchmarks, and returns each
+  question's tasks in the same order as the questions. The planner calls run
+  concurrently, at most max_concurrency at a time, on the shared OpenAI client, which
+  keeps the number of requests in flight under the API's rate limits.
+
+  This only plans, nothing is executed. Use run_batch in llm_compiler_graph.py to fully
+  answer a list of questions.
+  '''
+  return await get_planner().abatch(
+    [[HumanMessage(content=question)] for question in questions],
+    config={"max_concurrency": max_concurrency},
+  )
 
 
 # Example usage
 # example_question = "What's the temperature in SF raised to the 3rd power?"
 
-# for task in planner.stream([HumanMessage(content=example_question)]):
-  # print(task["tool"], task["args"])
-  # print("---")
\ No newline at end of file
+# for task in get_planner().stream([HumanMessage(content=example_question)]):
+  # print(task.tool, task.args)
+  # print("---")
+# Or from async code:
+# async for task in get_planner().astream([HumanMessage(content=example_question)]):
+  # print(task.tool, task.args)
+  # print("---")
+# Or plan many questions at once:
+# plans = asyncio.run(plan_many([example_question, "What's the GDP of New York?"]))
\ No newline at end of file
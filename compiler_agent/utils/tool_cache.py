@@ -0,0 +1,170 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from langchain_core.tools import BaseTool
+
+from utils.config import resolve_path
+
+
+# Returned by get() on a miss, since None could be a real tool result.
+MISS = object()
+
+
+def is_cacheable(tool: BaseTool) -> bool:
+  '''Tools opt in to result caching with metadata={"cacheable": True}. Only mark tools
+  that are safe to skip, ones that always give the same answer for the same args and have
+  no side effects.
+  '''
+  return bool(tool.metadata and tool.metadata.get("cacheable"))
+
+
+# An exception's repr, e.g. "HTTPError('429 Client Error ...')" or "ReadTimeout(...)".
+_ERROR_REPR_RE = re.compile(r"[A-Z]\w*(?:Error|Exception|Timeout)\(")
+
+
+def is_error_result(result: Any) -> bool:
+  '''Checks if a tool's result is an error it returned instead of raising. Some tools
+  catch their own exceptions and return repr(e), the Tavily search tool does this and so
+  does the math tool when numexpr fails. Those must not be cached, a timeout or rate
+  limit would otherwise be handed back for the whole TTL, including to the replan that's
+  meant to recover from it.
+  '''
+  return isinstance(result, str) and _ERROR_REPR_RE.match(result) is not None
+
+
+def make_key(tool_name: str, args: Any) -> Tuple[str, Hashable]:
+  '''Args are usually a dict, which can't be hashed, so they're dumped to JSON with
+  sorted keys. That way the same args always give the same key regardless of order.
+  '''
+  return tool_name, json.dumps(args, sort_keys=True, default=str)
+
+
+class ToolResultCache:
+  '''A thread safe LRU cache of tool results. Tasks run on a thread pool, so reads and
+  writes all go through a lock.
+
+  Results expire 'ttl' seconds after they're stored, so things like search results are
+  reused across replans but still get refreshed in a long running process. A ttl of None
+  keeps results until they're evicted.
+  '''
+
+  def __init__(self, maxsize: int = 512, ttl: Optional[float] = None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    # key -> (expiry time on the monotonic clock, result)
+    self._results: "OrderedDict[Tuple[str, Hashable], Tuple[float, Any]]" = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key: Tuple[str, Hashable]) -> Any:
+    with self._lock:
+      entry = self._results.get(key)
+      if entry is None:
+        return MISS
+      expires_at, value = entry
+      if expires_at < time.monotonic():
+        del self._results[key]
+        return MISS
+      # Mark as most recently used
+      self._results.move_to_end(key)
+      return value
+
+  def set(self, key: Tuple[str, Hashable], value: Any):
+    expires_at = float("inf") if self.ttl is None else time.monotonic() + self.ttl
+    with self._lock:
+      self._results[key] = (expires_at, value)
+      self._results.move_to_end(key)
+      # Drop the least recently used results once over the limit
+      while len(self._results) > self.maxsize:
+        self._results.popitem(last=False)
+
+
+class SQLiteToolResultCache:
+  '''The same cache as ToolResultCache, kept in a SQLite file so results survive
+  restarts and can be reused by later runs. Results are stored as JSON, ones that can't
+  be are simply not cached.
+
+  Expiry times are wall clock times, since the monotonic clock restarts with the
+  process. Once there are more than 'maxsize' results the oldest stored ones are
+  dropped. Results go in 'table', so caches of different things (tool results, plans)
+  never share rows, even when they share a file.
+  '''
+
+  def __init__(
+    self,
+    database_path: str,
+    maxsize: int = 512,
+    ttl: Optional[float] = None,
+    table: str = "tool_results",
+  ):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.table = table
+    # Tasks run on a thread pool, so the one connection is shared between threads and
+    # every use goes through the lock.
+    self._connection = sqlite3.connect(database_path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self._lock, self._connection:
+      self._connection.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} ("
+        " tool_name TEXT NOT NULL, args TEXT NOT NULL, expires_at REAL NOT NULL,"
+        " result TEXT NOT NULL, PRIMARY KEY (tool_name, args))"
+      )
+
+  def get(self, key: Tuple[str, str]) -> Any:
+    with self._lock:
+      row = self._connection.execute(
+        f"SELECT expires_at, result FROM {self.table} WHERE tool_name = ? AND args = ?",
+        key,
+      ).fetchone()
+      if row is None:
+        return MISS
+      expires_at, result = row
+      if expires_at < time.time():
+        with self._connection:
+          self._connection.execute(
+            f"DELETE FROM {self.table} WHERE tool_name = ? AND args = ?", key
+          )
+        return MISS
+    return json.loads(result)
+
+  def set(self, key: Tuple[str, str], value: Any):
+    try:
+      result = json.dumps(value)
+    except (TypeError, ValueError):
+      return
+    expires_at = float("inf") if self.ttl is None else time.time() + self.ttl
+    with self._lock, self._connection:
+      # REPLACE gives the row a new rowid, so rowid order is the order results were
+      # stored in.
+      self._connection.execute(
+        f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+        (*key, expires_at, result),
+      )
+      self._connection.execute(
+        f"DELETE FROM {self.table} WHERE rowid NOT IN"
+        f" (SELECT rowid FROM {self.table} ORDER BY rowid DESC LIMIT ?)",
+        (self.maxsize,),
+      )
+
+
+def build_tool_cache(cache_config: dict, table: str = "tool_results"):
+  '''Builds a result cache from a config section laid out like 'tool_cache'. The plan
+  cache ('plan_cache') is built the same way, with its own 'table'.
+  - 'sqlite': Kept in the file at 'database_path' (relative to compiler_agent/), reused
+    across runs. The default.
+  - 'memory': Kept in the process only, starts empty every run.
+  '''
+  if cache_config.get('type', 'sqlite') == 'memory':
+    return ToolResultCache(maxsize=cache_config['maxsize'], ttl=cache_config['ttl_seconds'])
+
+  return SQLiteToolResultCache(
+    database_path=resolve_path(cache_config['database_path']),
+    maxsize=cache_config['maxsize'],
+    ttl=cache_config['ttl_seconds'],
+    table=table,
+  )
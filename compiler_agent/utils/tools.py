@@ -1,33 +1,47 @@
-import json
-from langchain_openai import ChatOpenAI
+import functools
+from typing import List
 
-# Tool imports
-from langchain_community.tools.tavily_search import TavilySearchResults
-from utils.math_tools import get_math_tool
+from langchain_core.tools import BaseTool
+
+from utils.config import load_config
+from utils.llm import make_llm
 
 
 # Read config file
-with open('compiler_agent/config.json', 'r') as f:
-  config = json.load(f)
-
-calculate = get_math_tool(ChatOpenAI(**config['math_llm']))
-search = TavilySearchResults(
-  # Setting results to 2 for: shows possible return values from tools, they can be an
-  # array, a string, etc. For this tool it's an list of dicts. As a learning/tutorial,
-  # this will help illustrate better than 1, that the results are per tool and not
-  # standarized. Also not higher than 2 because costs for a free tutorial, keeping it
-  # low for that.
-  max_results=2,
-  # Setting a different description here than the default one.
-  description='tavily_search_results_json(query="the search query") - a search engine.',
-)
-
-tools = [search, calculate]
+config = load_config()
+
+
+@functools.cache
+def get_tools() -> List[BaseTool]:
+  '''Builds the tools on first use and returns the same list after that. The search and
+  math tools pull in the Tavily client, the math tool's chain and an LLM, so nothing is
+  loaded until a plan actually needs them.
+  '''
+  # Imported here for the same reason, they're only needed to build the tools.
+  from langchain_community.tools.tavily_search import TavilySearchResults
+  from utils.math_tools import get_math_tool
+
+  calculate = get_math_tool(make_llm(**config['math_llm']))
+  search = TavilySearchResults(
+    # Setting results to 2 for: shows possible return values from tools, they can be an
+    # array, a string, etc. For this tool it's an list of dicts. As a learning/tutorial,
+    # this will help illustrate better than 1, that the results are per tool and not
+    # standarized. Also not higher than 2 because costs for a free tutorial, keeping it
+    # low for that.
+    max_results=2,
+    # Setting a different description here than the default one.
+    description='tavily_search_results_json(query="the search query") - a search engine.',
+    # Same query, same results within a run, so repeat searches from replans can be
+    # served from the task fetching unit's cache.
+    metadata={"cacheable": True},
+  )
+  return [search, calculate]
 
 # Test the math tool
+# search, calculate = get_tools()
 # calculate.invoke(
 #  {
 #    "problem": "What's the temp of sf + 5?",
 #    "context": ["Thet empreature of sf is 32 degrees"],
 #  }
-# )
\ No newline at end of file
+# )